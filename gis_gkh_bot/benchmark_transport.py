@@ -0,0 +1,78 @@
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+# python benchmark_transport.py <house guid> [--requests 200] [--concurrency 16]
+# sends the same passport parameter searches a rooms crawl makes through every portal backend and compares them
+parser_ = argparse.ArgumentParser(description='Compare the portal transport backends on passport searches')
+parser_.add_argument('guid', help='house guid from a card link')
+parser_.add_argument('--requests', type=int, default=200)
+parser_.add_argument('--concurrency', type=int, default=16)
+args = parser_.parse_args()
+
+# the AIMD window would otherwise start at 2 and hide the difference between the backends
+os.environ.setdefault('PORTAL_INITIAL_CONCURRENCY', str(args.concurrency))
+os.environ.setdefault('PORTAL_MAX_CONCURRENCY', str(args.concurrency))
+
+from parser.limiter import AIMDController, PORTAL_INITIAL_CONCURRENCY, PORTAL_MIN_CONCURRENCY, \
+    PORTAL_MAX_CONCURRENCY, PORTAL_LATENCY_THRESHOLD, PORTAL_DECREASE_FACTOR  # noqa: E402
+from parser.room import HEADERS  # noqa: E402
+from parser.transport import AiohttpBackend, HttpxBackend, HTTP2_AVAILABLE  # noqa: E402
+
+URL = 'https://dom.gosuslugi.ru/homemanagement/api/rest/services/passports/search'
+
+
+def create_controller(name: str) -> AIMDController:
+    # every backend starts from the same window, the cuts of one run do not carry over into the next
+    return AIMDController(name, PORTAL_INITIAL_CONCURRENCY, PORTAL_MIN_CONCURRENCY, PORTAL_MAX_CONCURRENCY,
+                          PORTAL_LATENCY_THRESHOLD, PORTAL_DECREASE_FACTOR)
+
+
+async def run(name: str, backend: AiohttpBackend | HttpxBackend, controller: AIMDController) -> None:
+    latencies = []
+    errors = 0
+
+    async def fetch(index: int) -> None:
+        nonlocal errors
+        started = time.monotonic()
+        try:
+            await backend.request('POST', URL, headers=HEADERS, json={
+                'houseGuid': args.guid, 'passportParameterCode': '17' if index % 2 else '18', 'page': 1,
+                'itemsPerPage': 500
+            })
+        except Exception:
+            errors += 1
+        else:
+            latencies.append(time.monotonic() - started)
+
+    # one request first so that connection setup is not counted against the backend
+    await fetch(0)
+    latencies.clear()
+    started = time.monotonic()
+    await asyncio.gather(*(fetch(index) for index in range(args.requests)))
+    elapsed = time.monotonic() - started
+    await backend.close()
+    latencies.sort()
+    if not latencies:
+        print(f'{name:<12} all {errors} requests failed')
+        return
+    print(f'{name:<12} {len(latencies) / elapsed:7.1f} req/s  p50 {statistics.median(latencies) * 1000:7.0f} ms  '
+          f'p95 {latencies[int(len(latencies) * 0.95) - 1] * 1000:7.0f} ms  errors {errors}  '
+          f'window {controller.stats}')
+
+
+async def main() -> None:
+    print(f'{args.requests} requests, concurrency {args.concurrency}, h2 installed: {HTTP2_AVAILABLE}')
+    controller = create_controller('aiohttp')
+    await run('aiohttp', AiohttpBackend(controller), controller)
+    controller = create_controller('httpx h1')
+    await run('httpx h1', HttpxBackend(http2=False, controller=controller), controller)
+    if HTTP2_AVAILABLE:
+        controller = create_controller('httpx h2')
+        await run('httpx h2', HttpxBackend(http2=True, controller=controller), controller)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
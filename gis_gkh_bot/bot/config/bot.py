@@ -7,8 +7,11 @@ from redis.asyncio.utils import from_url
 
 TOKEN = os.environ.get("TOKEN")
 REDIS_HOST = os.environ.get("REDIS_HOST")
+# Telegram ids allowed to run /export, comma separated, nobody without them
+ADMIN_IDS = {int(id_) for id_ in os.environ.get("ADMIN_IDS", "").split(",") if id_.strip()}
 
 bot = Bot(TOKEN, parse_mode=ParseMode.HTML)
-__redis = from_url(REDIS_HOST)
-__redis_storage = RedisStorage(__redis)
+# from_url only builds a connection pool, the first command connects
+redis = from_url(REDIS_HOST)
+__redis_storage = RedisStorage(redis)
 dp = Dispatcher(storage=__redis_storage)
@@ -10,7 +10,7 @@ from loguru import logger
 from bot.handlers.start import get_orgs_string, MKDState
 from bot.keyboards.for_start import get_mkds_keyboard, MKDData, get_mkd_card_keyboard, MenuAction
 from parser.mkd import MKDParser
-from parser.saver import MKDDataSaver
+from parser.reports import get_mkd_report
 
 router = Router()
 parser = MKDParser()
@@ -44,8 +44,7 @@ async def on_entering_house_address(query: CallbackQuery, callback_data: MKDData
         text += 'Непосредственное управление\n'
     text += get_orgs_string(mkd, orgs)
     logger.debug('text formed')
-    saver = MKDDataSaver(mkd, orgs, rooms)
-    await saver.save_mkd_to_excel()
+    await get_mkd_report(mkd, orgs, rooms)
     await query.message.answer(text, reply_markup=await get_mkd_card_keyboard(mkd))
     await query.message.delete()
     await msg.delete()
@@ -1,8 +1,8 @@
 import asyncio
-from asyncio import Task
 from contextlib import suppress
 from dataclasses import asdict
 from datetime import datetime
+from functools import partial
 from pathlib import Path
 from typing import Literal
 
@@ -15,25 +15,35 @@ from aiogram.types import Message, InputMediaPhoto, FSInputFile, CallbackQuery
 from httpx import HTTPStatusError
 from loguru import logger
 
-from bot.config.bot import bot
+from bot.config.bot import bot, ADMIN_IDS
 from bot.keyboards.data_types import MenuAction, BoolCallbackData, Action, ContinueParsingData, CancelParsingData, \
     CollectPDFData, FoundRightMKDData, Button
+from bot.scheduler import JobScheduler, JobType, JobStatus, Job
 from bot.keyboards.for_start import get_continue_parsing_keyboard, \
     get_cancel_rooms_parsing_keyboard, get_confirm_rooms_parsing_cancel_keyboard, \
     get_mkd_card_keyboard, get_start_keyboard, get_found_right_keyboard
 from dadata_wrapper.dadataapi import get_address_data
+from parser.checkpoint import CrawlCheckpoints, CrawlCheckpoint
+from parser.export import export_all
 from parser.mkd import MKDParser, MKD
 from parser.organization import Organization
-from parser.saver import MKDDataSaver
+from parser.reports import get_mkd_report
 from parser.utils import BASE_DIR
-from pdf_collector.api import PDFCollector
 
 router = Router()
 parser = MKDParser()
+scheduler = JobScheduler()
 lock = asyncio.Lock()
 
 IMG_DIR = Path(__file__).parent / 'img'
 IS_DELETING_BUTTON = False
+# the largest document a bot can send
+TELEGRAM_FILE_LIMIT = 50 * 1024 * 1024
+JOB_TYPE_NAMES = {
+    JobType.ROOMS: 'Сбор помещений',
+    JobType.PDF: 'Отчет',
+    JobType.CARD: 'Карточка дома',
+}
 
 
 class MKDState(StatesGroup):
@@ -69,6 +79,33 @@ async def cmd_cancel(message: Message, state: FSMContext) -> None:
     await message.answer('Действие успешно отменено', )
 
 
+@router.message(Command(commands=['status']))
+async def cmd_status(message: Message) -> None:
+    jobs = scheduler.get_user_jobs(message.from_user.id)
+    if not jobs:
+        await message.answer('У вас нет запросов в работе')
+        return
+    lines = []
+    for job in jobs:
+        line = f'{JOB_TYPE_NAMES[job.type]} <b>{job.title}</b>: {job.status}'
+        if position := scheduler.get_position(job):
+            line += f', место в очереди: {position}'
+        lines.append(line)
+    await message.answer('\n'.join(lines), disable_web_page_preview=True)
+
+
+# the export reads the whole repository, it is kept to the admins and out of the command menu
+@router.message(Command(commands=['export']), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_export(message: Message) -> None:
+    msg = await message.answer('Собираю выгрузку по всем домам, это может занять несколько минут...')
+    for path in await export_all():
+        if path.stat().st_size > TELEGRAM_FILE_LIMIT:
+            await message.answer(f'Файл {path.name} слишком большой для отправки, он сохранен на сервере: {path}')
+        else:
+            await message.answer_document(FSInputFile(path))
+    await msg.delete()
+
+
 @router.message(Command(commands=['gisgkh']))
 async def cmd_infogis(message: Message, state: FSMContext) -> None:
     houses = InputMediaPhoto(
@@ -92,8 +129,10 @@ async def on_entering_house_link(message: Message, state: FSMContext) -> None:
     if not message.text.startswith('https://dom.gosuslugi.ru/#!/house-view'):
         await message.answer('Кажется, вы ввели некорректную ссылку. Попробуйте, пожалуйста, снова')
     else:
-        msg = await message.answer('Начинаю сбор информации из ГИС ЖКХ...\nПожалуйста, ожидайте сообщения')
-        mkd: MKD = await parser.run(message.text)
+        job = scheduler.submit(message.from_user.id, JobType.CARD, message.text, partial(parser.run, message.text))
+        msg = await message.answer(
+            f'Начинаю сбор информации из ГИС ЖКХ...\nПожалуйста, ожидайте сообщения{_get_queue_text(job)}')
+        mkd: MKD = await job.wait()
         orgs = await mkd.orgs
         if not mkd.id:
             cad_msg = await message.answer(
@@ -119,8 +158,7 @@ async def on_entering_house_link(message: Message, state: FSMContext) -> None:
         if 'непосредственное' in mkd.control_method.lower():
             text += 'Непосредственное управление\n'
         text += get_orgs_string(mkd, orgs)
-        saver = MKDDataSaver(mkd, orgs)
-        await saver.save_mkd_to_excel()
+        await get_mkd_report(mkd, orgs, await mkd.rooms)
         await message.answer(text, reply_markup=await get_mkd_card_keyboard(mkd))
         for msg_id in [message.message_id, msg.message_id, *data['msgs_to_delete_part']]:
             await bot.delete_message(message.chat.id, msg_id)
@@ -144,8 +182,7 @@ async def on_entering_house_cad_num(message: Message, state: FSMContext) -> None
     if 'непосредственное' in mkd.control_method.lower():
         text += 'Непосредственное управление\n'
     text += get_orgs_string(mkd, orgs)
-    saver = MKDDataSaver(mkd, orgs)
-    await saver.save_mkd_to_excel()
+    await get_mkd_report(mkd, orgs, await mkd.rooms)
     await message.answer(text, reply_markup=await get_mkd_card_keyboard(mkd))
     await bot.delete_message(message.chat.id, cad_msg_id)
     await message.delete()
@@ -158,9 +195,9 @@ async def on_entering_house_addr(message: Message, state: FSMContext) -> None:
     msg = await message.answer('Начинаю сбор информации\nПожалуйста, ожидайте сообщения')
     address = message.text
     try:
-        result = get_address_data(address)
+        result = await get_address_data(address)
         if 'Санкт-Петербург' in result.result and not result.house_cadnum:
-            result = get_address_data(f"{address} литера А")
+            result = await get_address_data(f"{address} литера А")
     except HTTPStatusError:
         addr_msg = await message.answer(
             'Произошла ошибка. Пожалуйста, нажмите /gisgkh, чтобы найти нужный дом в ГИС ЖКХ')
@@ -184,8 +221,10 @@ async def on_found_right_mkd_data(query: CallbackQuery, state: FSMContext) -> No
     await state.set_state(None)
     data = await state.get_data()
     await query.message.delete()
-    msg = await query.message.answer('Продолжаю сбор информации...\nПожалуйста, ожидайте сообщения')
-    mkd: MKD = await parser.run(address=data['addr'])
+    job = scheduler.submit(query.from_user.id, JobType.CARD, data['addr'], partial(parser.run, address=data['addr']))
+    msg = await query.message.answer(
+        f'Продолжаю сбор информации...\nПожалуйста, ожидайте сообщения{_get_queue_text(job)}')
+    mkd: MKD = await job.wait()
     orgs = await mkd.orgs
     if await parser.rooms_parser.mkd_has_rooms(mkd.id):
         await msg.delete()
@@ -198,8 +237,7 @@ async def on_found_right_mkd_data(query: CallbackQuery, state: FSMContext) -> No
     if 'непосредственное' in mkd.control_method.lower():
         text += 'Непосредственное управление\n'
     text += get_orgs_string(mkd, orgs)
-    saver = MKDDataSaver(mkd, orgs)
-    await saver.save_mkd_to_excel()
+    await get_mkd_report(mkd, orgs, await mkd.rooms)
     await query.message.answer(text, reply_markup=await get_mkd_card_keyboard(mkd), disable_webpage_preview=True)
     await msg.delete()
 
@@ -219,7 +257,8 @@ async def on_accept_download(query: CallbackQuery, callback_data: BoolCallbackDa
         await asyncio.sleep(2.5)
     async with lock:
         await _delete_button_from_message_markup(Button.TABLE, query.message)
-    file = FSInputFile(BASE_DIR / 'reports' / f'МКД_{mkd.cad_num}_{mkd.address.replace("/", "_")}.xlsx')
+    # the card has built this report from the same stored orgs and rooms, so it comes straight from the cache
+    file = FSInputFile(await get_mkd_report(mkd, await mkd.orgs, await mkd.rooms))
     await query.message.answer_document(file, )
     with suppress(TelegramBadRequest):
         await query.answer()
@@ -241,34 +280,34 @@ async def on_continue_parsing_accept(query: CallbackQuery, callback_data: Contin
     with suppress(TelegramBadRequest):
         await query.answer()
     orgs = await mkd.orgs
-    while parser.rooms_parser.is_running:
-        logger.debug(parser.rooms_parser.is_running)
-        await asyncio.sleep(10)
-    task = asyncio.create_task(
-        parser.rooms_parser.parse_mkd_rooms_by_guid(parser.parse_guid_from_card_link(mkd.card_link), mkd))
+    guid = parser.parse_guid_from_card_link(mkd.card_link)
+    # a crawl of the same house already queued or running is joined instead of started again
+    job = scheduler.find_job(JobType.ROOMS, guid)
+    if not job:
+        if callback_data.rm_rooms:
+            # a new crawl starts from scratch, the rooms are never deleted once its checkpoint exists
+            await CrawlCheckpoints().finish(guid)
+            await parser.rooms_parser.delete_rooms_by_mkd_id(callback_data.id)
+        job = scheduler.submit(query.from_user.id, JobType.ROOMS, mkd.address,
+                               partial(parser.rooms_parser.parse_mkd_rooms_by_guid, guid, mkd, chat_id), key=guid)
     msg = await bot.send_message(
         chat_id,
-        f'Cобираю данные о помещениях из <a href="{mkd.passport_link}">эл.паспорта дома</a> по адресу <b>{mkd.address}</b>. Пожалуйста, ожидайте сообщения',
-        reply_markup=get_cancel_rooms_parsing_keyboard(task, mkd.id)
+        f'Cобираю данные о помещениях из <a href="{mkd.passport_link}">эл.паспорта дома</a> по адресу <b>{mkd.address}</b>. Пожалуйста, ожидайте сообщения{_get_queue_text(job)}',
+        reply_markup=get_cancel_rooms_parsing_keyboard(job, mkd.id)
     )
-    if callback_data.rm_rooms:
-        await parser.rooms_parser.delete_rooms_by_mkd_id(callback_data.id)
-    await task
-    if task.result():
-        saver = MKDDataSaver(mkd, orgs, task.result())
-        await saver.save_mkd_to_excel()
+    rooms = await job.wait()
+    if rooms:
+        await get_mkd_report(mkd, orgs, rooms)
         data = await state.get_data()
         await query.message.delete()
         with suppress(TelegramBadRequest, Exception):
             await msg.delete()
             await bot.delete_message(query.message.chat.id, data.get('continue_msg_id'))
-        text = f'<a href="{mkd.card_link}">МКД</a>: <b>{mkd.address} ({mkd.cad_num})\n\n{parser.get_rooms_report_string(mkd, task.result())}</b>\n\n'
+        text = f'<a href="{mkd.card_link}">МКД</a>: <b>{mkd.address} ({mkd.cad_num})\n\n{parser.get_rooms_report_string(mkd, rooms)}</b>\n\n'
         if 'непосредственное' in mkd.control_method.lower():
             text += 'Непосредственное управление\n'
         text += get_orgs_string(mkd, orgs)
         logger.debug('text formed')
-        saver = MKDDataSaver(mkd, orgs, task.result())
-        await saver.save_mkd_to_excel()
         await query.message.answer(text, reply_markup=await get_mkd_card_keyboard(mkd))
 
 
@@ -282,8 +321,7 @@ async def on_continue_parsing_decline(query: CallbackQuery, callback_data: Conti
     if 'непосредственное' in mkd.control_method.lower():
         text += 'Непосредственное управление\n'
     text += get_orgs_string(mkd, orgs)
-    saver = MKDDataSaver(mkd, orgs, rooms)
-    await saver.save_mkd_to_excel()
+    await get_mkd_report(mkd, orgs, rooms)
     await query.message.answer(text, reply_markup=await get_mkd_card_keyboard(mkd))
     with suppress(TelegramBadRequest):
         await query.answer()
@@ -292,11 +330,15 @@ async def on_continue_parsing_decline(query: CallbackQuery, callback_data: Conti
 @router.callback_query(CancelParsingData.filter(F.action == Action.REQUEST))
 async def on_cancel_parsing(query: CallbackQuery, callback_data: CancelParsingData) -> None:
     await query.message.delete()
-    parser.rooms_parser.stopped = True
     mkd = await parser.find_mkd_by_id(callback_data.mkd_id)
-    task = await _get_task_by_name(callback_data.task_name)
+    job = scheduler.get_job(callback_data.job_id)
+    if not job or job.status not in (JobStatus.QUEUED, JobStatus.RUNNING):
+        await query.message.answer(f'Сбор данных о помещениях МКД <b>{mkd.address} ({mkd.cad_num})</b> уже завершен')
+        await query.answer()
+        return
+    parser.rooms_parser.paused.add(callback_data.mkd_id)
     await query.message.answer(f'Парсинг помещений МКД <b>{mkd.address} ({mkd.cad_num})</b> приостановлен',
-                               reply_markup=get_confirm_rooms_parsing_cancel_keyboard(task, callback_data.mkd_id))
+                               reply_markup=get_confirm_rooms_parsing_cancel_keyboard(job, callback_data.mkd_id))
     await query.answer()
 
 
@@ -304,12 +346,14 @@ async def on_cancel_parsing(query: CallbackQuery, callback_data: CancelParsingDa
 async def on_cancel_parsing_accept(query: CallbackQuery, callback_data: CancelParsingData) -> None:
     logger.debug('cancel parsing')
     await query.answer()
-    task = await _get_task_by_name(callback_data.task_name)
-    task.cancel()
-    parser.rooms_parser.stopped = False
-    parser.rooms_parser.is_running = False
+    job = scheduler.get_job(callback_data.job_id)
+    if job and scheduler.cancel(job.id):
+        # the crawl must be gone before its checkpoint and rooms are dropped
+        await job.wait()
+    parser.rooms_parser.paused.discard(callback_data.mkd_id)
     await parser.rooms_parser.delete_rooms_by_mkd_id(callback_data.mkd_id)
     mkd = await parser.find_mkd_by_id(callback_data.mkd_id)
+    await CrawlCheckpoints().finish(parser.parse_guid_from_card_link(mkd.card_link))
     await query.message.answer(
         f'Сбор данных о <a href="{mkd.passport_link}">помещениях</a> МКД <b>{mkd.address} ({mkd.cad_num})</b> успешно отменен')
     await query.message.delete()
@@ -319,12 +363,12 @@ async def on_cancel_parsing_accept(query: CallbackQuery, callback_data: CancelPa
 async def on_cancel_parsing_decline(query: CallbackQuery, callback_data: CancelParsingData,
                                     state: FSMContext) -> None:
     await query.message.delete()
-    parser.rooms_parser.stopped = False
+    parser.rooms_parser.paused.discard(callback_data.mkd_id)
     mkd = await parser.find_mkd_by_id(callback_data.mkd_id)
-    task = await _get_task_by_name(callback_data.task_name)
+    job = scheduler.get_job(callback_data.job_id)
     msg = await query.message.answer(
         f'Сбор данных о <a href="{mkd.passport_link}">помещениях</a> МКД <b>{mkd.address} ({mkd.cad_num})</b> успешно продолжен',
-        reply_markup=get_cancel_rooms_parsing_keyboard(task, callback_data.mkd_id)
+        reply_markup=get_cancel_rooms_parsing_keyboard(job, callback_data.mkd_id) if job else None
     )
     await query.answer()
     await state.update_data({'continue_msg_id': msg.message_id})
@@ -345,17 +389,57 @@ async def on_collect_pdf(query: CallbackQuery, callback_data: CollectPDFData) ->
         await _delete_button_from_message_markup(btn_pressed, query.message)
     files = await get_mkd_pdf_files_by_address(mkd.address)
     if not files[callback_data.action]:
-        collector = PDFCollector()
-        while collector.is_running:
-            await asyncio.sleep(10)
-        task = asyncio.create_task(collector.run(callback_data.action, mkd.passport_link, mkd.orgs_link, mkd.address))
-        await task
-        files[callback_data.action] = task.result()
+        from pdf_collector.api import PDFCollector
+        job = scheduler.submit(
+            query.from_user.id, JobType.PDF, f'{btn_pressed} {mkd.address}',
+            partial(PDFCollector().run, callback_data.action, mkd.passport_link, mkd.orgs_link, mkd.address),
+            key=f'{callback_data.action}:{mkd.id}'
+        )
+        if queue_text := _get_queue_text(job):
+            await msg.edit_text(f'{msg.text}{queue_text}')
+        files[callback_data.action] = await job.wait()
     doc = FSInputFile(files[callback_data.action])
     await msg.delete()
     await query.message.answer_document(doc)
 
 
+async def resume_rooms_crawls() -> None:
+    try:
+        checkpoints = await CrawlCheckpoints().get_unfinished()
+    except Exception as ex:
+        logger.exception(ex)
+        return
+    results = await asyncio.gather(*map(_resume_rooms_crawl, checkpoints), return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logger.exception(result)
+
+
+async def _resume_rooms_crawl(checkpoint: CrawlCheckpoint) -> None:
+    mkd = await parser.find_mkd_by_id(checkpoint.mkd_id)
+    if not mkd:
+        await CrawlCheckpoints().finish(checkpoint.guid)
+        return
+    job = scheduler.submit(checkpoint.chat_id or 0, JobType.ROOMS, mkd.address,
+                           partial(parser.rooms_parser.parse_mkd_rooms_by_guid, checkpoint.guid, mkd),
+                           key=checkpoint.guid)
+    if checkpoint.chat_id:
+        await bot.send_message(
+            checkpoint.chat_id,
+            f'Бот был перезапущен. Продолжаю сбор данных о помещениях из <a href="{mkd.passport_link}">эл.паспорта дома</a> по адресу <b>{mkd.address}</b>: собрано {checkpoint.completed}, осталось {len(checkpoint.remaining)}. Пожалуйста, ожидайте сообщения{_get_queue_text(job)}',
+            reply_markup=get_cancel_rooms_parsing_keyboard(job, mkd.id)
+        )
+    rooms = await job.wait()
+    if rooms and checkpoint.chat_id:
+        orgs = await mkd.orgs
+        await get_mkd_report(mkd, orgs, rooms)
+        text = f'<a href="{mkd.card_link}">МКД</a>: <b>{mkd.address} ({mkd.cad_num})\n\n{parser.get_rooms_report_string(mkd, rooms)}</b>\n\n'
+        if 'непосредственное' in mkd.control_method.lower():
+            text += 'Непосредственное управление\n'
+        text += get_orgs_string(mkd, orgs)
+        await bot.send_message(checkpoint.chat_id, text, reply_markup=await get_mkd_card_keyboard(mkd))
+
+
 def get_orgs_string(mkd: MKD, orgs: list[Organization]):
     text = ''
     for org in orgs:
@@ -365,12 +449,9 @@ def get_orgs_string(mkd: MKD, orgs: list[Organization]):
     return text
 
 
-async def _get_task_by_name(task_name: str) -> Task:
-    loop = asyncio.get_running_loop()
-    tasks = asyncio.all_tasks(loop)
-    for task in tasks:
-        if task.get_name() == task_name:
-            return task
+def _get_queue_text(job: Job) -> str:
+    position = scheduler.get_position(job)
+    return f'\nВаш запрос в очереди: {position}' if position else ''
 
 
 async def get_mkd_pdf_files_by_address(address: str) -> dict[Literal['control_info', 'passport'], Path | None]:
@@ -40,7 +40,7 @@ class ContinueParsingData(CallbackData, prefix='continue_parsing'):
 
 class CancelParsingData(CallbackData, prefix='cancel_parsing'):
     action: Action
-    task_name: str
+    job_id: int
     mkd_id: str
 
 
@@ -1,5 +1,3 @@
-from asyncio import Task
-
 from aiogram.types import ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram.utils.keyboard import ReplyKeyboardBuilder, KeyboardButton, InlineKeyboardBuilder
 from loguru import logger
@@ -7,6 +5,7 @@ from loguru import logger
 from bot.keyboards.data_types import Button, MenuAction, FoundRightMKDData, BoolCallbackData, Action, MKDData, \
     CollectPDFData, \
     ContinueParsingData, CancelParsingData
+from bot.scheduler import Job
 from parser.mkd import MKD
 from parser.organization import Organization
 
@@ -99,24 +98,24 @@ def get_continue_parsing_keyboard(mkd: MKD, rm_rooms: bool = False,
     return builder.as_markup(resize_keyboard=True, one_time_keyboard=True)
 
 
-def get_cancel_rooms_parsing_keyboard(task: Task, mkd_id: str) -> InlineKeyboardMarkup:
+def get_cancel_rooms_parsing_keyboard(job: Job, mkd_id: str) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.add(InlineKeyboardButton(
         text='Отменить',
-        callback_data=CancelParsingData(task_name=task.get_name(), mkd_id=mkd_id, action=Action.REQUEST).pack()))
+        callback_data=CancelParsingData(job_id=job.id, mkd_id=mkd_id, action=Action.REQUEST).pack()))
     builder.adjust(1)
     return builder.as_markup(resize_keyboard=True, one_time_keyboard=True)
 
 
-def get_confirm_rooms_parsing_cancel_keyboard(task: Task, mkd_id: str) -> InlineKeyboardMarkup:
+def get_confirm_rooms_parsing_cancel_keyboard(job: Job, mkd_id: str) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.add(InlineKeyboardButton(
         text='Продолжить',
-        callback_data=CancelParsingData(task_name=task.get_name(), mkd_id=mkd_id, action=Action.DECLINE).pack()
+        callback_data=CancelParsingData(job_id=job.id, mkd_id=mkd_id, action=Action.DECLINE).pack()
     ))
     builder.add(InlineKeyboardButton(
         text='Удалить',
-        callback_data=CancelParsingData(task_name=task.get_name(), mkd_id=mkd_id, action=Action.ACCEPT).pack()
+        callback_data=CancelParsingData(job_id=job.id, mkd_id=mkd_id, action=Action.ACCEPT).pack()
     ))
     builder.adjust(2)
     return builder.as_markup(resize_keyboard=True, one_time_keyboard=True)
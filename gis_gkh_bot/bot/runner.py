@@ -1,24 +1,71 @@
+import asyncio
+from asyncio import Task
+
 from aiogram.types import BotCommand
 from loguru import logger
 
+from dadata_wrapper.dadataapi import close_dadata
+from parser.mirror import SheetsMirror
+from parser.reports import close_report_pool
+from parser.transport import PortalTransport
+from parser.utils import share_spreadsheet
+from parser.writer import SheetsWriter
 from .handlers import start, infogis
-from .config.bot import bot, dp
+from .handlers.start import resume_rooms_crawls
+from .config.bot import bot, dp, redis
+
+warm_up_task: Task | None = None
 
 
 async def register_commands() -> None:
     commands = [
         BotCommand(command="gisgkh", description="Получить данные ГИС ЖКХ"),
         BotCommand(command="infogis", description="Показать данные по дому"),
+        BotCommand(command="status", description="Показать очередь запросов"),
         BotCommand(command="cancel", description="Отменить действие"),
 
     ]
     await bot.set_my_commands(commands)
 
 
+async def warm_up() -> None:
+    # every step only logs its failure, the periodic mirror refresh and writer flush retry Google on their own
+    # playwright is only loaded here, after polling has started
+    from pdf_collector.pool import BrowserPool
+    mirror = SheetsMirror()
+    for step in (register_commands, redis.ping, share_spreadsheet, mirror.load, BrowserPool().start):
+        try:
+            await step()
+        except Exception as ex:
+            logger.exception(ex)
+    mirror.start()
+    SheetsWriter().start()
+    logger.success("Bot has warmed up")
+    await resume_rooms_crawls()
+
+
+async def on_startup() -> None:
+    # runs right before polling, the handlers work off the repository until the mirror is loaded
+    global warm_up_task
+    warm_up_task = asyncio.create_task(warm_up())
+
+
+async def on_shutdown() -> None:
+    if warm_up_task:
+        warm_up_task.cancel()
+    await SheetsWriter().flush()
+    await close_dadata()
+    await PortalTransport().close()
+    close_report_pool()
+    from pdf_collector.pool import BrowserPool
+    await BrowserPool().close()
+
+
 async def run_bot():
     dp.include_router(start.router)
     dp.include_router(infogis.router)
-    await register_commands()
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
     logger.success("Bot has started successfully")
     await bot.delete_webhook(drop_pending_updates=True)
     await dp.start_polling(bot)
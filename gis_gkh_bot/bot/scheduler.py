@@ -0,0 +1,156 @@
+import asyncio
+import os
+from asyncio import Task, Future
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from enum import StrEnum
+from functools import partial
+from itertools import count
+from typing import Any, Awaitable, Callable, NoReturn
+
+from loguru import logger
+
+from parser.utils import Singleton
+
+
+class JobType(StrEnum):
+    ROOMS = 'rooms'
+    PDF = 'pdf'
+    CARD = 'card'
+
+
+class JobStatus(StrEnum):
+    QUEUED = 'в очереди'
+    RUNNING = 'выполняется'
+    DONE = 'готово'
+    FAILED = 'ошибка'
+    CANCELLED = 'отменено'
+
+
+JOB_LIMITS = {
+    JobType.ROOMS: int(os.environ.get('JOBS_ROOMS_CONCURRENCY', 2)),
+    # no more than PDF_POOL_SIZE run at once anyway, the rest wait for a browser context
+    JobType.PDF: int(os.environ.get('JOBS_PDF_CONCURRENCY', 2)),
+    JobType.CARD: int(os.environ.get('JOBS_CARD_CONCURRENCY', 4)),
+}
+JOBS_HISTORY_SIZE = int(os.environ.get('JOBS_HISTORY_SIZE', 100))
+
+
+@dataclass
+class Job:
+    id: int
+    user_id: int
+    type: JobType
+    title: str
+    key: str | None
+    factory: Callable[[], Awaitable[Any]] = field(repr=False)
+    status: JobStatus = field(default=JobStatus.QUEUED)
+    future: Future = field(default_factory=lambda: asyncio.get_running_loop().create_future(), repr=False)
+    task: Task | None = field(default=None, repr=False)
+
+    async def wait(self) -> Any:
+        # the waiting handler never cancels the job itself, a cancelled job just gives None
+        await asyncio.wait([self.future])
+        return None if self.future.cancelled() else self.future.result()
+
+
+class JobScheduler(metaclass=Singleton):
+    # every job type has its own concurrency limit and a FIFO per user, the users take turns in round-robin
+    def __init__(self):
+        self.__ids = count(1)
+        self.__jobs: dict[int, Job] = {}
+        self.__finished: deque[int] = deque()
+        self.__queues: dict[JobType, OrderedDict[int, deque[Job]]] = {type_: OrderedDict() for type_ in JobType}
+        self.__running = {type_: 0 for type_ in JobType}
+
+    def submit(self, user_id: int, type_: JobType, title: str, factory: Callable[[], Awaitable[Any]],
+               key: str = None) -> Job:
+        if key and (job := self.find_job(type_, key)):
+            return job
+        job = Job(next(self.__ids), user_id, type_, title, key, factory)
+        self.__jobs[job.id] = job
+        self.__queues[type_].setdefault(user_id, deque()).append(job)
+        self.__dispatch(type_)
+        logger.info(f'Job {job.id} ({type_}, {title}) of {user_id} submitted: {job.status}, {self.stats}')
+        return job
+
+    def get_job(self, job_id: int) -> Job | None:
+        return self.__jobs.get(job_id)
+
+    def find_job(self, type_: JobType, key: str) -> Job | None:
+        for job in self.__jobs.values():
+            if job.type == type_ and job.key == key and job.status in (JobStatus.QUEUED, JobStatus.RUNNING):
+                return job
+        return None
+
+    def get_user_jobs(self, user_id: int) -> list[Job]:
+        return [job for job in self.__jobs.values() if job.user_id == user_id]
+
+    def get_position(self, job: Job) -> int:
+        # 1-based place among the queued jobs of the same type in the order the round-robin will start them
+        if job.status != JobStatus.QUEUED:
+            return 0
+        queues = list(self.__queues[job.type].values())
+        order = [queue[turn] for turn in range(max(map(len, queues))) for queue in queues if turn < len(queue)]
+        return order.index(job) + 1
+
+    def cancel(self, job_id: int) -> bool:
+        job = self.__jobs.get(job_id)
+        if not job:
+            return False
+        if job.status == JobStatus.QUEUED:
+            queues = self.__queues[job.type]
+            queues[job.user_id].remove(job)
+            if not queues[job.user_id]:
+                del queues[job.user_id]
+            job.future.cancel()
+            self.__set_finished(job, JobStatus.CANCELLED)
+            return True
+        if job.status == JobStatus.RUNNING:
+            job.task.cancel()
+            return True
+        return False
+
+    @property
+    def stats(self) -> dict[str, dict[str, int]]:
+        return {
+            type_: {'running': self.__running[type_], 'queued': sum(map(len, self.__queues[type_].values()))}
+            for type_ in JobType
+        }
+
+    def __dispatch(self, type_: JobType) -> NoReturn:
+        queues = self.__queues[type_]
+        while queues and self.__running[type_] < JOB_LIMITS[type_]:
+            user_id, queue = queues.popitem(last=False)
+            job = queue.popleft()
+            if queue:
+                # the user goes to the end of the rotation with the rest of their jobs
+                queues[user_id] = queue
+            self.__start(job)
+
+    def __start(self, job: Job) -> NoReturn:
+        job.status = JobStatus.RUNNING
+        self.__running[job.type] += 1
+        job.task = asyncio.create_task(job.factory(), name=f'job-{job.id}')
+        job.task.add_done_callback(partial(self.__on_done, job))
+
+    def __on_done(self, job: Job, task: Task) -> NoReturn:
+        self.__running[job.type] -= 1
+        if task.cancelled():
+            job.future.cancel()
+            self.__set_finished(job, JobStatus.CANCELLED)
+        elif task.exception():
+            job.future.set_exception(task.exception())
+            self.__set_finished(job, JobStatus.FAILED)
+            logger.opt(exception=task.exception()).error(f'Job {job.id} ({job.type}, {job.title}) failed')
+        else:
+            job.future.set_result(task.result())
+            self.__set_finished(job, JobStatus.DONE)
+        self.__dispatch(job.type)
+
+    def __set_finished(self, job: Job, status: JobStatus) -> NoReturn:
+        job.status = status
+        self.__finished.append(job.id)
+        while len(self.__finished) > JOBS_HISTORY_SIZE:
+            self.__jobs.pop(self.__finished.popleft(), None)
+        logger.info(f'Job {job.id} ({job.type}, {job.title}) of {job.user_id}: {status}, {self.stats}')
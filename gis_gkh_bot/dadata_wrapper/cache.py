@@ -0,0 +1,98 @@
+import os
+import sqlite3
+import time
+from pathlib import Path
+from typing import Any
+
+import ujson
+from loguru import logger
+
+DADATA_CACHE_PATH = os.environ.get('DADATA_CACHE_PATH', str(Path(__file__).parent.parent / 'dadata_cache.sqlite3'))
+DADATA_CACHE_TTL = float(os.environ.get('DADATA_CACHE_TTL', 90 * 24 * 60 * 60))
+DADATA_CACHE_NEGATIVE_TTL = float(os.environ.get('DADATA_CACHE_NEGATIVE_TTL', 24 * 60 * 60))
+DADATA_CACHE_MAX_ENTRIES = int(os.environ.get('DADATA_CACHE_MAX_ENTRIES', 200_000))
+# access times of the hits are kept in memory and written this many at a time, or with the next set
+DADATA_CACHE_ACCESS_BATCH_SIZE = int(os.environ.get('DADATA_CACHE_ACCESS_BATCH_SIZE', 500))
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY, value TEXT, expires_at REAL NOT NULL, accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at);
+'''
+
+MISSING = object()
+
+
+class DadataCache:
+    # raw DaData responses by lookup key, a None value is a cached "not found" and lives for the shorter negative TTL
+    def __init__(self, path: str = DADATA_CACHE_PATH):
+        self.__connection = sqlite3.connect(path, check_same_thread=False)
+        self.__connection.executescript(SCHEMA)
+        self.__writes = 0
+        # access times not written yet, they only order the eviction so losing them on a restart is harmless
+        self.__accessed: dict[str, float] = {}
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.__evict()
+
+    @property
+    def stats(self) -> dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits, 'negative_hits': self.negative_hits, 'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            'entries': self.__connection.execute('SELECT COUNT(*) FROM responses').fetchone()[0],
+        }
+
+    def get(self, key: str) -> Any:
+        now = time.time()
+        row = self.__connection.execute(
+            'SELECT value FROM responses WHERE key = ? AND expires_at > ?', (key, now)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return MISSING
+        self.__accessed[key] = now
+        if len(self.__accessed) >= DADATA_CACHE_ACCESS_BATCH_SIZE:
+            with self.__connection:
+                self.__write_accessed()
+        self.hits += 1
+        if row[0] is None:
+            self.negative_hits += 1
+            return None
+        return ujson.loads(row[0])
+
+    def set(self, key: str, value: Any) -> None:
+        now = time.time()
+        ttl = DADATA_CACHE_TTL if value else DADATA_CACHE_NEGATIVE_TTL
+        self.__accessed.pop(key, None)
+        with self.__connection:
+            self.__write_accessed()
+            self.__connection.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)',
+                (key, ujson.dumps(value, ensure_ascii=False) if value else None, now + ttl, now)
+            )
+        self.__writes += 1
+        if self.__writes % 1000 == 0:
+            self.__evict()
+
+    def __write_accessed(self) -> None:
+        if self.__accessed:
+            self.__connection.executemany(
+                'UPDATE responses SET accessed_at = ? WHERE key = ?', ((at, key) for key, at in self.__accessed.items())
+            )
+            self.__accessed.clear()
+
+    def __evict(self) -> None:
+        with self.__connection:
+            self.__write_accessed()
+            self.__connection.execute('DELETE FROM responses WHERE expires_at <= ?', (time.time(),))
+            # least recently used entries go first once the cache is over its size
+            self.__connection.execute(
+                'DELETE FROM responses WHERE key IN '
+                '(SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+                (DADATA_CACHE_MAX_ENTRIES,)
+            )
+        logger.info(f'DaData cache evicted: {self.stats}')
@@ -2,39 +2,124 @@ import json
 import os
 from functools import lru_cache
 
-from cachetools.func import ttl_cache
-from dadata import Dadata
+import httpx
+from async_lru import alru_cache
 from loguru import logger
 
+from .cache import DadataCache, MISSING
+
 token = os.environ.get("DADATA_TOKEN")
 secret = os.environ.get("DADATA_SECRET")
-dadata = Dadata(token, secret)
+
+DADATA_TIMEOUT = float(os.environ.get('DADATA_TIMEOUT', 10))
+DADATA_MAX_CONNECTIONS = int(os.environ.get('DADATA_MAX_CONNECTIONS', 10))
+DADATA_KEEPALIVE_EXPIRY = float(os.environ.get('DADATA_KEEPALIVE_EXPIRY', 60))
+DADATA_BATCH_SIZE = int(os.environ.get('DADATA_BATCH_SIZE', 50))
+
+CLEAN_URL = 'https://cleaner.dadata.ru/api/v1'
+SUGGESTIONS_URL = 'https://suggestions.dadata.ru/suggestions/api/4_1/rs'
+
+
+class DadataClient:
+    # one pooled keep-alive connection set for both DaData hosts, unlike dadata.DadataAsync, which opens a client
+    # per API and has no connection limits
+    def __init__(self, token: str, secret: str = None):
+        headers = {
+            'Content-Type': 'application/json',
+            'Accept': 'application/json',
+            'Authorization': f'Token {token}',
+        }
+        if secret:
+            headers['X-Secret'] = secret
+        self.__client = httpx.AsyncClient(
+            headers=headers,
+            timeout=httpx.Timeout(DADATA_TIMEOUT, connect=5),
+            limits=httpx.Limits(max_connections=DADATA_MAX_CONNECTIONS,
+                                max_keepalive_connections=DADATA_MAX_CONNECTIONS,
+                                keepalive_expiry=DADATA_KEEPALIVE_EXPIRY),
+        )
+
+    async def clean(self, name: str, source: str) -> dict | None:
+        response = await self.__post(f'{CLEAN_URL}/clean/{name}', [source])
+        return response[0] if response else None
+
+    async def clean_records(self, structure: list[str], records: list[list[str]]) -> list[list[dict]]:
+        response = await self.__post(f'{CLEAN_URL}/clean', {'structure': structure, 'data': records})
+        return response['data']
+
+    async def find_by_id(self, name: str, query: str, count: int = 10, **kwargs) -> list[dict]:
+        response = await self.__post(f'{SUGGESTIONS_URL}/findById/{name}', {'query': query, 'count': count, **kwargs})
+        return response['suggestions']
+
+    async def close(self) -> None:
+        await self.__client.aclose()
+
+    async def __post(self, url: str, data: dict | list) -> dict | list:
+        response = await self.__client.post(url, json=data)
+        response.raise_for_status()
+        return response.json()
 
 
-@ttl_cache(maxsize=128, ttl=600)
-def get_address_data(address):
-    print('dadataapi get_address_data', address)
-    print(f'dadataapi: поиск адреса {address}')
-    dadata_service = Dadata(token, secret)
-    result = dadata_service.clean("address", address)
+@lru_cache(maxsize=None)
+def get_dadata() -> DadataClient:
+    return DadataClient(token, secret)
+
+
+async def close_dadata() -> None:
+    if get_dadata.cache_info().currsize:
+        await get_dadata().close()
+
+
+@lru_cache(maxsize=None)
+def get_dadata_cache() -> DadataCache:
+    return DadataCache()
+
+
+# the in-process alru_cache sits in front of the persistent DadataCache, which keeps the raw responses between restarts
+
+@alru_cache(maxsize=128, ttl=600)
+async def get_address_data(address):
+    result = get_dadata_cache().get(f'clean:address:{address}')
+    if result is MISSING:
+        logger.debug(f'dadataapi: поиск адреса {address}')
+        result = await get_dadata().clean("address", address)
+        get_dadata_cache().set(f'clean:address:{address}', result)
     return AddressData(result) if result else None
 
 
-@ttl_cache(maxsize=128, ttl=600)
-def get_address_data_by_id(id_: str):
-    print('dadataapi get_address_data_by_id')
-    print(f'dadataapi: поиск по КадНомеру: {id_}')
-    result = dadata.find_by_id('address', id_)
-    print(len(result))
-    print(result)
+async def get_addresses_data(addresses: list[str]) -> list['AddressData | None']:
+    # the composite clean endpoint takes up to DADATA_BATCH_SIZE records, cached addresses are not sent again
+    cache = get_dadata_cache()
+    results = [cache.get(f'clean:address:{address}') for address in addresses]
+    missing = list({address for address, result in zip(addresses, results) if result is MISSING})
+    cleaned = {}
+    for start in range(0, len(missing), DADATA_BATCH_SIZE):
+        batch = missing[start:start + DADATA_BATCH_SIZE]
+        logger.debug(f'dadataapi: пакетная очистка {len(batch)} адресов')
+        for address, record in zip(batch, await get_dadata().clean_records(['ADDRESS'], [[a] for a in batch])):
+            cleaned[address] = record[0] if record else None
+            cache.set(f'clean:address:{address}', cleaned[address])
+    results = [cleaned[address] if result is MISSING else result for address, result in zip(addresses, results)]
+    return [AddressData(result) if result else None for result in results]
+
+
+@alru_cache(maxsize=128, ttl=600)
+async def get_address_data_by_id(id_: str):
+    result = get_dadata_cache().get(f'find:address:{id_}')
+    if result is MISSING:
+        logger.debug(f'dadataapi: поиск по КадНомеру: {id_}')
+        result = await get_dadata().find_by_id('address', id_)
+        get_dadata_cache().set(f'find:address:{id_}', result)
     return AddressData(result[0]['data']) if result else None
 
 
-@ttl_cache(maxsize=128, ttl=600)
-def get_organization_by_inn(inn):
-    print(f'dadataapi: поиск ИНН {inn}')
-    dadata_service = Dadata(token, secret)
-    result = dadata_service.find_by_id('party', inn, 1, branch_type='MAIN')
+@alru_cache(maxsize=128, ttl=600)
+async def get_organization_by_inn(inn):
+    result = get_dadata_cache().get(f'find:party:{inn}')
+    if result is MISSING:
+        logger.debug(f'dadataapi: поиск ИНН {inn}')
+        result = await get_dadata().find_by_id('party', inn, 1, branch_type='MAIN')
+        get_dadata_cache().set(f'find:party:{inn}', result)
     with open('./test_responses/dadata_org.json', 'w') as f:
         json.dump(result, f, indent=4, ensure_ascii=False)
     if result:
@@ -185,5 +270,6 @@ class CompanyData:
 
 
 if __name__ == '__main__':
-    x = get_address_data('Санкт Петербург ул Марата д 40 кв.3')
+    import asyncio
+    x = asyncio.run(get_address_data('Санкт Петербург ул Марата д 40 кв.3'))
     print(f'{x.postal_code}, {x.street_type}.{x.street}, {x.house_type}.{x.house}, {x.flat_type}.{x.flat}')
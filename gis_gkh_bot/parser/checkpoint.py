@@ -0,0 +1,74 @@
+from dataclasses import dataclass, field
+from typing import NoReturn
+
+import ujson
+
+from .utils import Singleton, get_redis
+
+CRAWLS_KEY = 'crawls'
+
+
+@dataclass
+class CrawlCheckpoint:
+    guid: str
+    mkd_id: str = field(default='')
+    chat_id: int | None = field(default=None)
+    completed: int = field(default=0)
+    remaining: list[dict] = field(default_factory=list)
+
+
+class CrawlCheckpoints(metaclass=Singleton):
+    # every unfinished room crawl keeps its meta in crawl:<guid> and the passport items still to fetch, keyed by
+    # their param code, in crawl:<guid>:remaining, so a restarted bot continues where the crawl stopped
+
+    async def start(self, guid: str, mkd_id: str, chat_id: int | None, items: list[dict]) -> NoReturn:
+        async with get_redis().pipeline(transaction=True) as pipe:
+            pipe.delete(self.__key(guid), self.__remaining_key(guid))
+            pipe.hset(self.__key(guid), mapping={'mkd_id': mkd_id, 'chat_id': chat_id or '', 'completed': 0})
+            if items:
+                pipe.hset(self.__remaining_key(guid), mapping={
+                    item['paramCode']: ujson.dumps({'index': index, **item}, ensure_ascii=False)
+                    for index, item in enumerate(items)
+                })
+            pipe.sadd(CRAWLS_KEY, guid)
+            await pipe.execute()
+
+    async def get(self, guid: str) -> CrawlCheckpoint | None:
+        redis = get_redis()
+        meta = await redis.hgetall(self.__key(guid))
+        if not meta:
+            return None
+        items = [ujson.loads(item) for item in (await redis.hvals(self.__remaining_key(guid)))]
+        items.sort(key=lambda item: item.pop('index'))
+        return CrawlCheckpoint(guid, meta['mkd_id'], int(meta['chat_id']) if meta['chat_id'] else None,
+                               int(meta['completed']), items)
+
+    async def get_unfinished(self) -> list[CrawlCheckpoint]:
+        checkpoints = []
+        for guid in await get_redis().smembers(CRAWLS_KEY):
+            checkpoint = await self.get(guid)
+            if checkpoint:
+                checkpoints.append(checkpoint)
+            else:
+                await get_redis().srem(CRAWLS_KEY, guid)
+        return checkpoints
+
+    async def complete(self, guid: str, param_code: str) -> NoReturn:
+        async with get_redis().pipeline(transaction=True) as pipe:
+            pipe.hdel(self.__remaining_key(guid), param_code)
+            pipe.hincrby(self.__key(guid), 'completed')
+            await pipe.execute()
+
+    async def finish(self, guid: str) -> NoReturn:
+        async with get_redis().pipeline(transaction=True) as pipe:
+            pipe.delete(self.__key(guid), self.__remaining_key(guid))
+            pipe.srem(CRAWLS_KEY, guid)
+            await pipe.execute()
+
+    @staticmethod
+    def __key(guid: str) -> str:
+        return f'crawl:{guid}'
+
+    @staticmethod
+    def __remaining_key(guid: str) -> str:
+        return f'crawl:{guid}:remaining'
@@ -0,0 +1,164 @@
+import csv
+import os
+from dataclasses import asdict, fields
+from importlib.util import find_spec
+from pathlib import Path
+from typing import NoReturn, Any, Iterator
+
+from loguru import logger
+
+from .mkd import MKD
+from .organization import Organization
+from .reports import run_in_report_pool
+from .repository import Repository, Table, SHEETS
+from .room import Room
+from .utils import BASE_DIR, single_flight
+
+EXPORTS_DIR = BASE_DIR / 'exports'
+# rows per Parquet row group, the only part of a table an export holds in memory
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 10_000))
+# Parquet files are only written with pyarrow installed, pip install pyarrow
+PARQUET_AVAILABLE = find_spec('pyarrow') is not None
+
+MODELS = {
+    Table.MKDS: MKD,
+    Table.ORGS: Organization,
+    Table.ROOMS: Room,
+}
+# typed columns of the export, every other column is text
+FLOAT_COLUMNS = {
+    Table.MKDS: {'total_area', 'residential_square'},
+    Table.ORGS: set(),
+    Table.ROOMS: {'total_area', 'residential_square', 'dadata_area'},
+}
+INT_COLUMNS = {
+    Table.MKDS: {'built_year'},
+    Table.ORGS: set(),
+    Table.ROOMS: {'rooms_count', 'entrance_number'},
+}
+
+
+class ColumnarWriter:
+    # one table as CSV and Parquet, the CSV rows go straight to the file and the Parquet ones are buffered up to
+    # a row group
+    def __init__(self, directory: Path, table: Table):
+        self.__table = table
+        self.__columns = [field.name for field in fields(MODELS[table])]
+        self.__csv_path = directory / f'{table}.csv'
+        self.__csv_file = open(_get_tmp_path(self.__csv_path), 'w', newline='', encoding='utf-8')
+        self.__csv = csv.writer(self.__csv_file)
+        self.__csv.writerow(self.__columns)
+        self.__parquet_path = directory / f'{table}.parquet'
+        self.__parquet = None
+        self.__batch: list[dict] = []
+        if PARQUET_AVAILABLE:
+            import pyarrow.parquet as pq
+            self.__parquet = pq.ParquetWriter(_get_tmp_path(self.__parquet_path), self.__get_schema())
+
+    @property
+    def paths(self) -> list[Path]:
+        return [self.__csv_path, self.__parquet_path] if self.__parquet else [self.__csv_path]
+
+    def write(self, record: dict[str, Any]) -> NoReturn:
+        self.__csv.writerow(record.values())
+        if self.__parquet:
+            self.__batch.append(record)
+            if len(self.__batch) >= EXPORT_BATCH_SIZE:
+                self.__flush()
+
+    def close(self) -> NoReturn:
+        self.__csv_file.close()
+        _get_tmp_path(self.__csv_path).replace(self.__csv_path)
+        if self.__parquet:
+            self.__flush()
+            self.__parquet.close()
+            _get_tmp_path(self.__parquet_path).replace(self.__parquet_path)
+
+    def __flush(self) -> NoReturn:
+        import pyarrow as pa
+        if not self.__batch:
+            return
+        typed = FLOAT_COLUMNS[self.__table] | INT_COLUMNS[self.__table]
+        columns = {
+            column: [
+                record[column] if column in typed or record[column] is None else str(record[column])
+                for record in self.__batch
+            ] for column in self.__columns
+        }
+        self.__parquet.write_table(pa.table(columns, schema=self.__get_schema()))
+        self.__batch.clear()
+
+    def __get_schema(self) -> Any:
+        import pyarrow as pa
+        return pa.schema([
+            (column, pa.float64() if column in FLOAT_COLUMNS[self.__table] else
+             pa.int64() if column in INT_COLUMNS[self.__table] else pa.string())
+            for column in self.__columns
+        ])
+
+
+@single_flight(lambda: None)
+async def export_all() -> list[Path]:
+    # the export goes through the report pool like a report, so it is queued with them and the bot keeps
+    # answering while it runs
+    return [Path(path) for path in await run_in_report_pool(export_to_files, str(EXPORTS_DIR))]
+
+
+def export_to_files(directory: str) -> list[str]:
+    # every house, organization and room from the repository in one pass over each table: one workbook with
+    # the sheets of the house reports, and a CSV and Parquet file per table with numeric areas and counts
+    from .saver import create_workbook, create_sheet, append_header, append_row, MKD_HEADERS, ORGS_HEADERS, \
+        ROOMS_HEADERS
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    wb = create_workbook()
+    paths = []
+    for table, headers in ((Table.MKDS, MKD_HEADERS), (Table.ORGS, ORGS_HEADERS), (Table.ROOMS, ROOMS_HEADERS)):
+        sheet = create_sheet(wb, SHEETS[table])
+        append_header(sheet, headers)
+        writer = ColumnarWriter(directory, table)
+        count = 0
+        for record in _iter_records(table):
+            append_row(sheet, record.values())
+            writer.write(record)
+            count += 1
+        writer.close()
+        paths += writer.paths
+        logger.info(f'Exported {count} rows of {table}')
+    workbook = directory / 'export.xlsx'
+    wb.save(_get_tmp_path(workbook))
+    _get_tmp_path(workbook).replace(workbook)
+    return [str(path) for path in [workbook, *paths]]
+
+
+def _iter_records(table: Table) -> Iterator[dict[str, Any]]:
+    model = MODELS[table]
+    for row in Repository().iter_rows(table):
+        record = asdict(model(*row))
+        for column in FLOAT_COLUMNS[table]:
+            record[column] = _to_number(record[column], float)
+        for column in INT_COLUMNS[table]:
+            record[column] = _to_number(record[column], int)
+        yield record
+
+
+def _get_tmp_path(path: Path) -> Path:
+    # every file is written under a temporary name and renamed once complete, so a reader never sees half of it
+    return path.with_name(f'{path.name}.tmp')
+
+
+def _to_number(value: Any, type_: type[int] | type[float]) -> int | float | None:
+    # areas are floats when parsed from the portal but strings with a decimal comma when mirrored from the
+    # sheet, empty and unparsable values such as a failed DaData area are exported as empty cells
+    if value is None or value == '':
+        return None
+    try:
+        return type_(float(str(value).replace(' ', '').replace(',', '.')))
+    except (ValueError, OverflowError):
+        return None
+
+
+if __name__ == '__main__':
+    # python -m parser.export, the same export without the bot
+    for path in export_to_files(str(EXPORTS_DIR)):
+        print(path)
@@ -0,0 +1,125 @@
+import asyncio
+import os
+import random
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from enum import IntEnum
+from typing import NoReturn, Callable, AsyncIterator
+
+import httpx
+from aiohttp import ClientError, ClientResponse
+from loguru import logger
+
+PORTAL_INITIAL_CONCURRENCY = float(os.environ.get('PORTAL_INITIAL_CONCURRENCY', 2))
+PORTAL_MIN_CONCURRENCY = float(os.environ.get('PORTAL_MIN_CONCURRENCY', 1))
+PORTAL_MAX_CONCURRENCY = float(os.environ.get('PORTAL_MAX_CONCURRENCY', 16))
+PORTAL_LATENCY_THRESHOLD = float(os.environ.get('PORTAL_LATENCY_THRESHOLD', 5))
+PORTAL_DECREASE_FACTOR = float(os.environ.get('PORTAL_DECREASE_FACTOR', 0.5))
+
+
+class Lane(IntEnum):
+    INTERACTIVE = 0
+    BULK = 1
+
+
+# lane of the Google Sheets calls made from the current task, bulk jobs switch it for their own calls
+sheets_lane: ContextVar[Lane] = ContextVar('sheets_lane', default=Lane.INTERACTIVE)
+
+
+class TokenBucket:
+    def __init__(self, rate_per_minute: float, capacity: float):
+        self.__rate = rate_per_minute / 60
+        self.__capacity = capacity
+        self.__tokens = capacity
+        self.__updated = time.monotonic()
+        self.__waiting = {lane: 0 for lane in Lane}
+
+    async def acquire(self, tokens: float = 1, lane: Lane = Lane.INTERACTIVE) -> NoReturn:
+        self.__waiting[lane] += 1
+        try:
+            while True:
+                self.__refill()
+                if self.__tokens >= tokens and not any(self.__waiting[lane_] for lane_ in Lane if lane_ < lane):
+                    self.__tokens -= tokens
+                    return
+                await asyncio.sleep(max((tokens - self.__tokens) / self.__rate, 0.05))
+        finally:
+            self.__waiting[lane] -= 1
+
+    def drain(self) -> NoReturn:
+        self.__refill()
+        self.__tokens = 0
+
+    def __refill(self) -> NoReturn:
+        now = time.monotonic()
+        self.__tokens = min(self.__capacity, self.__tokens + (now - self.__updated) * self.__rate)
+        self.__updated = now
+
+
+def get_backoff_delay(attempt: int, base: float, cap: float) -> float:
+    # full jitter, the retries of the clients hit by the same quota error spread over the whole window
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class AIMDController:
+    def __init__(self, name: str, initial: float, minimum: float, maximum: float, latency_threshold: float,
+                 decrease_factor: float):
+        self.__name = name
+        self.__window = initial
+        self.__minimum = minimum
+        self.__maximum = maximum
+        self.__latency_threshold = latency_threshold
+        self.__decrease_factor = decrease_factor
+        self.__in_flight = 0
+        self.__last_cut = 0.0
+        self.__cuts = 0
+        self.__condition = asyncio.Condition()
+
+    @property
+    def window(self) -> float:
+        return self.__window
+
+    @property
+    def stats(self) -> dict[str, float]:
+        return {'window': round(self.__window, 2), 'in_flight': self.__in_flight, 'cuts': self.__cuts}
+
+    @asynccontextmanager
+    async def request(self, method: Callable, *args, **kwargs) -> AsyncIterator[ClientResponse | httpx.Response]:
+        async with self.__condition:
+            await self.__condition.wait_for(lambda: self.__in_flight < int(self.__window))
+            self.__in_flight += 1
+        started = time.monotonic()
+        try:
+            async with method(*args, **kwargs) as response:
+                latency = time.monotonic() - started
+                # aiohttp and httpx name the status differently
+                status = response.status if isinstance(response, ClientResponse) else response.status_code
+                failed = status == 429 or status >= 500 or latency > self.__latency_threshold
+                self.__observe(started, failed)
+                yield response
+        except (asyncio.TimeoutError, ClientError, httpx.TransportError):
+            self.__observe(started, True)
+            raise
+        finally:
+            async with self.__condition:
+                self.__in_flight -= 1
+                self.__condition.notify_all()
+
+    def __observe(self, started: float, failed: bool) -> NoReturn:
+        if not failed:
+            # one more slot per window of successful requests, like TCP congestion avoidance
+            self.__window = min(self.__maximum, self.__window + 1 / self.__window)
+        elif started > self.__last_cut:
+            # requests sent before the last cut saw the old window, their failures are not counted twice
+            self.__window = max(self.__minimum, self.__window * self.__decrease_factor)
+            self.__last_cut = time.monotonic()
+            self.__cuts += 1
+            logger.warning(f'{self.__name} concurrency cut: {self.stats}')
+
+
+# shared by MKDParser, OrganizationsParser and RoomsParser, all of them hit dom.gosuslugi.ru
+portal_controller = AIMDController(
+    'dom.gosuslugi.ru', PORTAL_INITIAL_CONCURRENCY, PORTAL_MIN_CONCURRENCY, PORTAL_MAX_CONCURRENCY,
+    PORTAL_LATENCY_THRESHOLD, PORTAL_DECREASE_FACTOR
+)
@@ -0,0 +1,103 @@
+import asyncio
+import os
+import time
+from asyncio import Task
+from contextlib import suppress
+from typing import NoReturn
+
+import gspread_asyncio
+from gspread.exceptions import APIError
+from loguru import logger
+
+from .repository import Repository, SHEETS
+from .utils import Singleton, SheetHandles, agcm, get_spreadsheet
+from .writer import SheetsWriter
+
+MIRROR_REFRESH_INTERVAL = float(os.environ.get('MIRROR_REFRESH_INTERVAL', 300))
+MIRROR_WRITE_DELAY = float(os.environ.get('MIRROR_WRITE_DELAY', 10))
+# an outside edit shares the revision with the writes of the bot to other sheets, so after a refresh of the written
+# sheets only every sheet is downloaded again within this time
+MIRROR_FULL_REFRESH_INTERVAL = float(os.environ.get('MIRROR_FULL_REFRESH_INTERVAL', 10 * 60))
+
+TABLES = {title: table for table, title in SHEETS.items()}
+
+
+class SheetsMirror(metaclass=Singleton):
+    def __init__(self):
+        # last downloaded values of every sheet, an unchanged sheet is not written to the repository again
+        self.__values: dict[str, list[list[str]]] = {}
+        self.__revision: str | None = None
+        # time of the first refresh of the written sheets only since every sheet was last downloaded
+        self.__partial_since: float | None = None
+        self.__lock = asyncio.Lock()
+        self.__task: Task | None = None
+
+    def start(self) -> NoReturn:
+        if not self.__task:
+            self.__task = asyncio.create_task(self.__refresh_periodically())
+
+    async def load(self) -> NoReturn:
+        await self.refresh(force=True)
+
+    async def refresh(self, force: bool = False) -> NoReturn:
+        async with self.__lock:
+            sh = await get_spreadsheet()
+            revision = await agcm.get_revision(sh)
+            full = self.__partial_since is not None and \
+                time.monotonic() - self.__partial_since >= MIRROR_FULL_REFRESH_INTERVAL
+            if revision == self.__revision and not force and not full:
+                return
+            # Google keeps one revision per spreadsheet, so sheets written by the bot itself are the only ones
+            # known to have changed; anything else means an outside edit and every sheet is downloaded again
+            written, agcm.written_sheets = agcm.written_sheets, set()
+            titles = [title for title in TABLES if title in written]
+            if force or full or not titles or None in written:
+                titles = list(TABLES)
+            partial = len(titles) < len(TABLES)
+            # sheets with writes still queued in SheetsWriter are behind the repository, so they wait for the flush
+            pending = Repository().get_pending_write_titles().intersection(titles)
+            agcm.written_sheets.update(pending)
+            titles = [title for title in titles if title not in pending]
+            if titles:
+                try:
+                    skipped = await self.__download(sh, titles)
+                except APIError:
+                    SheetHandles().invalidate()
+                    raise
+                agcm.written_sheets.update(skipped)
+                pending.update(skipped)
+            # the sheets left for the flush are downloaded with the next refresh anyway
+            self.__partial_since = (self.__partial_since or time.monotonic()) if partial else None
+            if not pending:
+                self.__revision = revision
+        logger.debug(f'Sheet handles: {SheetHandles().stats}')
+
+    async def __download(self, sh: gspread_asyncio.AsyncioGspreadSpreadsheet, titles: list[str]) -> set[str]:
+        response = await sh.values_batch_get([f"'{title}'" for title in titles])
+        repository = Repository()
+        # rows saved while the download was running are not in it yet, the sheets that got writes since the
+        # check in refresh are left to the next refresh after the flush
+        with SheetsWriter().journal_lock:
+            skipped = repository.get_pending_write_titles().intersection(titles)
+            for title, value_range in zip(titles, response['valueRanges']):
+                values = value_range.get('values', [])
+                if title in skipped or values == self.__values.get(title):
+                    continue
+                self.__values[title] = values
+                width = len(values[0]) if values else 0
+                repository.replace_rows(TABLES[title], (row + [''] * (width - len(row)) for row in values[1:]))
+                logger.info(f'Mirrored {len(values[1:])} rows of {title} sheet')
+        if skipped:
+            logger.info(f'Sheets written during the download are mirrored after the flush: {skipped}')
+        return skipped
+
+    async def __refresh_periodically(self) -> NoReturn:
+        while True:
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(agcm.written.wait(), MIRROR_REFRESH_INTERVAL)
+                await asyncio.sleep(MIRROR_WRITE_DELAY)
+            agcm.written.clear()
+            try:
+                await self.refresh()
+            except Exception as ex:
+                logger.exception(ex)
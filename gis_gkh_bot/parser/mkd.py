@@ -1,11 +1,10 @@
 import math
+import os
 from dataclasses import dataclass, field, fields, asdict
 from typing import NoReturn, Any
 from urllib.parse import urlparse, parse_qs
 
-import ujson
 from aiogram.types import User
-from aiohttp import ClientSession
 from async_property import async_property
 from httpx import HTTPStatusError
 from jmespath import search
@@ -13,8 +12,13 @@ from loguru import logger
 
 from dadata_wrapper.dadataapi import get_address_data, get_address_data_by_id, AddressData
 from .organization import OrganizationsParser, Organization
+from .repository import Repository, Table, SHEETS, KEYS
 from .room import RoomsParser, Room
-from .utils import Singleton, agcm
+from .transport import PortalTransport
+from .utils import Singleton, single_flight
+from .writer import SheetsWriter
+
+PORTAL_CARD_CACHE_TTL = float(os.environ.get('PORTAL_CARD_CACHE_TTL', 24 * 60 * 60))
 
 
 @dataclass
@@ -45,14 +49,8 @@ class MKD:
 
     @async_property
     async def orgs(self) -> list[Organization]:
-        orgs = []
-        orgs_sheet = await OrganizationsParser.get_orgs_sheet()
-        for inn in f"{self.inn_uo};{self.inn_rso}".split(';'):
-            cell = await orgs_sheet.find(inn)
-            row = await orgs_sheet.row_values(cell.row)
-            org = Organization(*row)
-            orgs.append(org)
-        return orgs
+        inns = [inn for inn in f"{self.inn_uo};{self.inn_rso}".split(';') if inn]
+        return await OrganizationsParser.find_orgs_by_inns(inns)
 
     @async_property
     async def rooms(self) -> list[Room]:
@@ -66,9 +64,8 @@ class MKD:
 
 class MKDParser(metaclass=Singleton):
     def __init__(self):
-        self.__session: ClientSession = None
-        self.orgs_parser = None
-        self.rooms_parser = None
+        self.orgs_parser = OrganizationsParser()
+        self.rooms_parser = RoomsParser()
         self.orgs = []
         self.mkd = MKD()
         self.__base_mkd_endpoint_url = 'https://dom.gosuslugi.ru/homemanagement/api/rest/services/houses/public/1'
@@ -89,12 +86,8 @@ class MKDParser(metaclass=Singleton):
             'Sec-Fetch-Site': 'same-origin',
         }
 
+    @single_flight(lambda self, link=None, address=None: (link, address))
     async def run(self, link: str = None, address: str = None) -> MKD:
-        # tasks = []
-        if not self.__session:
-            self.__session = ClientSession(trust_env=True)
-            self.orgs_parser = OrganizationsParser(self.__session)
-            self.rooms_parser = RoomsParser(self.__session)
         mkd = await self.__find_mkd_by_link(link)
         if not mkd:
             mkd = MKD()
@@ -112,30 +105,23 @@ class MKDParser(metaclass=Singleton):
     async def __find_mkd_by_link(self, link: str) -> MKD | None:
         if not link:
             return None
-        mkd_sheet = await self.__get_mkd_sheet()
-        cell = await mkd_sheet.find(link)
-        if not cell:
-            return None
-        else:
-            row = await mkd_sheet.row_values(cell.row)
-            mkd = MKD(*row)
-            return mkd
+        row = Repository().find_mkd_by_link(link)
+        return MKD(*row) if row else None
 
     async def __get_mkd_card_data(self, mkd: MKD) -> dict | None:
         if not mkd.card_link and mkd.address:
             try:
-                result = get_address_data(mkd.address)
+                result = await get_address_data(mkd.address)
                 if 'Санкт-Петербург' in result.result and 'литер' not in result.result:
-                    result = get_address_data(f"{result.result} литер А")
+                    result = await get_address_data(f"{result.result} литер А")
                 region_id = result.region_fias_id
                 house_cad_num = result.house_cadnum
             except HTTPStatusError:
                 return None
             mkd.card_link = await self.__find_house_link_by_region_and_cad_num(region_id, house_cad_num)
         guid = self.parse_guid_from_card_link(mkd.card_link)
-        async with self.__session.get(f"{self.__base_mkd_endpoint_url}/{guid}") as response:
-            data = await response.json(loads=ujson.loads)
-            return data
+        return await PortalTransport().get_json(f"{self.__base_mkd_endpoint_url}/{guid}",
+                                                cache_ttl=PORTAL_CARD_CACHE_TTL)
 
     async def __find_house_link_by_region_and_cad_num(self, region_id: str, house_cad_num: str) -> str:
         url = f'https://dom.gosuslugi.ru/homemanagement/api/rest/services/houses/public/searchByAddress?pageIndex=1&elementsPerPage=10'
@@ -143,11 +129,10 @@ class MKDParser(metaclass=Singleton):
                 "strStatus": None, "calcCount": True, "houseConditionRefList": None, "houseTypeRefList": None,
                 "houseManagementTypeRefList": None, "cadastreNumber": house_cad_num, "oktmo": None,
                 "statuses": ["APPROVED"], "regionProperty": None, "municipalProperty": None, "hostelTypeCodes": None}
-        async with self.__session.post(url, json=data, headers=self.__headers) as response:
-            res = await response.json(loads=ujson.loads)
-            item = res['items'][0]
-            link = f'https://dom.gosuslugi.ru/#!/house-view?guid={item.get("guid")}&typeCode=1'
-            return link
+        res = await PortalTransport().post_json(url, data, headers=self.__headers)
+        item = res['items'][0]
+        link = f'https://dom.gosuslugi.ru/#!/house-view?guid={item.get("guid")}&typeCode=1'
+        return link
 
 
     @staticmethod
@@ -158,7 +143,6 @@ class MKDParser(metaclass=Singleton):
 
     async def __parse_characteristics(self, data: dict[str, Any], mkd: MKD) -> NoReturn:
         logger.info('parse characteristics')
-        orgs: list[Organization] = []
         mkd.address = self.__parse_address(data)
         mkd.address_id = self.__parse_address_id(data)
         mkd.control_method = self.__parse_control_method(data)
@@ -170,11 +154,11 @@ class MKDParser(metaclass=Singleton):
         mkd.total_area = self.__parse_total_square(data)
         mkd.residential_square = self.__parse_residential_square(data)
         mkd.built_year = self.__parse_built_year(data)
-        mkd.inn_uo = await self.__parse_inn_uo(data, orgs)
-        mkd.inn_rso = await self.__parse_inn_rso(data, orgs)
-        self.__parse_dadata_fields(mkd)
+        orgs = await self.__parse_orgs(data)
+        mkd.inn_uo = ';'.join(org.inn for org in orgs if org.status == 'УО')
+        mkd.inn_rso = ';'.join(org.inn for org in orgs if org.status == 'РСО')
+        await self.__parse_dadata_fields(mkd)
         await self.save_mkd_data(mkd)
-        await self.orgs_parser.save_orgs_data(orgs)
 
     @staticmethod
     def __parse_address(data: dict) -> str:
@@ -222,34 +206,20 @@ class MKDParser(metaclass=Singleton):
         inns.extend(mkd.inn_rso.split(';'))
         self.orgs = await self.orgs_parser.find_orgs_by_inns(inns)
 
-    async def __parse_inn_uo(self, data: dict, orgs: list[Organization]) -> str:
-        guid = search('managementOrganization.guid', data)
-        if not guid:
-            return ''
-        org = await self.orgs_parser.parse_org_by_guid('УО', guid)
-        orgs.append(org)
-        return org.inn
-
-    async def __parse_inn_rso(self, data: dict, orgs: list[Organization]) -> str:
-        inn_rso_str = ';'
-        inns = []
-        orgs_ = search('resourceProvisionOrganizationList', data)
-        if not orgs_:
-            return ''
-        for organization in orgs_:
-            guid = search('guid', organization)
-            org = await self.orgs_parser.parse_org_by_guid('РСО', guid)
-            orgs.append(org)
-            inns.append(org.inn)
-        return inn_rso_str.join(inns)
+    async def __parse_orgs(self, data: dict) -> list[Organization]:
+        # the УО and every РСО are fetched at once with a single additionalinfo call for all of them
+        guids = [('УО', search('managementOrganization.guid', data))]
+        guids.extend(('РСО', search('guid', organization))
+                     for organization in search('resourceProvisionOrganizationList', data) or [])
+        return await self.orgs_parser.parse_orgs_by_guids([(status, guid) for status, guid in guids if guid])
 
     def __parse_passport_link(self, mkd: MKD) -> str:
         return f"https://dom.gosuslugi.ru/#!/passport/show?houseGuid={self.parse_guid_from_card_link(mkd.card_link)}"
 
     @classmethod
-    def __parse_dadata_fields(cls, mkd: MKD) -> str:
+    async def __parse_dadata_fields(cls, mkd: MKD) -> NoReturn:
         try:
-            result = get_address_data_by_id(mkd.cad_num)
+            result = await get_address_data_by_id(mkd.cad_num)
         except HTTPStatusError:
             cls.__set_mkd_dadata_error_fields(mkd)
         else:
@@ -280,16 +250,19 @@ class MKDParser(metaclass=Singleton):
 
     async def save_mkd_data(self, mkd: MKD) -> NoReturn:
         logger.debug('Save mkd to gsheets')
-        data = asdict(mkd)
-        mkd_sheet = await self.__get_mkd_sheet()
-        cell = await mkd_sheet.find(mkd.card_link)
-        if cell:
-            row = await mkd_sheet.row_values(cell.row)
-            if row[0] == '':
-                await mkd_sheet.delete_row(cell.row)
-                await mkd_sheet.append_row(values=list(data.values()))
-        else:
-            await mkd_sheet.append_row(values=list(data.values()))
+        row = list(asdict(mkd).values())
+        repository = Repository()
+        writer = SheetsWriter()
+        with writer.journal_lock:
+            stored = repository.find_mkd_by_link(mkd.card_link)
+            # a complete stored house is kept as it is in the repository and in the sheet alike, so the two never
+            # disagree and the mirror has nothing to put back
+            if stored and stored[0] != '':
+                return
+            repository.save_mkd(row)
+            if stored:
+                writer.delete(SHEETS[Table.MKDS], KEYS[Table.MKDS][1], mkd.card_link)
+            writer.append(SHEETS[Table.MKDS], row)
 
     def get_rooms_report_string(self, mkd: MKD, rooms: list[Room]) -> str:
         if rooms:
@@ -332,42 +305,13 @@ class MKDParser(metaclass=Singleton):
 
     @staticmethod
     async def get_all_mkds() -> list[MKD]:
-        mkds = []
-        mkds_sheet = await MKDParser.__get_mkd_sheet()
-        rows_count = mkds_sheet.row_count
-        logger.debug(rows_count)
-        for row_num in range(2, rows_count + 1):
-            row = await mkds_sheet.row_values(row_num)
-            if not row:
-                break
-            logger.info(row)
-            mkds.append(MKD(*row))
-        return mkds
+        return [MKD(*row) for row in Repository().get_all_mkds()]
 
     async def find_mkd_by_id(self, id_: str) -> MKD:
-        if not self.__session:
-            self.__session = ClientSession()
-            self.orgs_parser = OrganizationsParser(self.__session)
-            self.rooms_parser = RoomsParser(self.__session)
-        mkds_sheet = await MKDParser.__get_mkd_sheet()
-        for row_num in range(2, mkds_sheet.row_count + 1):
-            row = await mkds_sheet.row_values(row_num)
-            if id_ in row:
-                return MKD(*row)
-
-    @staticmethod
-    async def __get_mkd_sheet():
-        agc = await agcm.authorize()
-        sh = await agc.open_by_url(
-            'https://docs.google.com/spreadsheets/d/1kGCdugwpVwuDO5LRC7tOxIkvMt_5iFQlGphLMAL107A/edit#gid=0')
-        mkd_sheet = await sh.worksheet('МКД')
-        return mkd_sheet
+        row = Repository().find_mkd_by_id(id_)
+        return MKD(*row) if row else None
 
     @staticmethod
     async def write_user_data(user: User, entry_datetime: str) -> NoReturn:
-        agc = await agcm.authorize()
-        sh = await agc.open_by_url(
-            'https://docs.google.com/spreadsheets/d/1kGCdugwpVwuDO5LRC7tOxIkvMt_5iFQlGphLMAL107A/edit#gid=0')
-        users_sheet = await sh.worksheet('Журнал')
         row = [entry_datetime, user.username, user.first_name]
-        await users_sheet.append_row(row)
+        SheetsWriter().append('Журнал', row)
@@ -1,16 +1,32 @@
 import asyncio
-from dataclasses import dataclass, field, asdict
+import hashlib
+import os
+import time
+from asyncio import Task
+from dataclasses import dataclass, field, asdict, replace
 from datetime import datetime
 from enum import StrEnum
 from typing import NoReturn, Literal
 
 import ujson
-from aiohttp import ClientSession
 from jmespath import search
 from loguru import logger
 
 from dadata_wrapper.dadataapi import get_organization_by_inn
-from .utils import Singleton, extract_digits_from_string, agcm
+from .limiter import TokenBucket
+from .repository import Repository, Table, SHEETS, KEYS
+from .transport import PortalTransport
+from .utils import Singleton, extract_digits_from_string
+from .writer import SheetsWriter
+
+ORGS_PER_MINUTE = float(os.environ.get('ORGS_PER_MINUTE', 30))
+ORGS_BURST = float(os.environ.get('ORGS_BURST', 5))
+ORGS_ADDITIONAL_INFO_BATCH_SIZE = int(os.environ.get('ORGS_ADDITIONAL_INFO_BATCH_SIZE', 50))
+# stored organisations younger than ORGS_FRESH_TTL are served as they are, older ones are served and refreshed in
+# the background, and only those fetched longer than ORGS_MAX_STALENESS ago make the caller wait for the portal
+ORGS_FRESH_TTL = float(os.environ.get('ORGS_FRESH_TTL', 24 * 60 * 60))
+ORGS_MAX_STALENESS = float(os.environ.get('ORGS_MAX_STALENESS', 30 * 24 * 60 * 60))
+PORTAL_ORG_CACHE_TTL = float(os.environ.get('PORTAL_ORG_CACHE_TTL', 24 * 60 * 60))
 
 
 @dataclass
@@ -51,40 +67,154 @@ class OrgStatus(StrEnum):
 
 
 class OrganizationsParser(metaclass=Singleton):
-    def __init__(self, session: ClientSession):
-        self.__session = session
+    def __init__(self):
         self.__base_org_endpoint_url = 'https://dom.gosuslugi.ru/ppa/api/rest/services/ppa/public/organizations'
+        # one budget for the organisations of every house, replaces the fixed pause after each of them
+        self.__bucket = TokenBucket(ORGS_PER_MINUTE, ORGS_BURST)
+        # portal fetches in flight by organisation guid, shared by the callers of every house and the background
+        # refreshes
+        self.__fetching: dict[str, Task] = {}
+
+    async def parse_orgs_by_guids(self, guids: list[tuple[Literal['УО', 'РСО'], str]]) -> list[Organization]:
+        # the registry answers from the repository, the portal is only waited for organisations it does not know
+        repository = Repository()
+        now = time.time()
+        orgs: dict[str, Organization] = {}
+        missing, stale = [], []
+        for guid, status in dict((guid, status) for status, guid in guids).items():
+            row = repository.find_org_by_link(self.__get_link(guid))
+            entry = repository.get_org_registry_entry(guid)
+            # rows loaded from the sheet have no registry entry yet and are revalidated like stale ones
+            age = now - entry[2] if entry else ORGS_FRESH_TTL
+            if row is None or age > ORGS_MAX_STALENESS:
+                missing.append((status, guid))
+                continue
+            orgs[guid] = Organization(*row)
+            if age >= ORGS_FRESH_TTL:
+                stale.append((status, guid))
+        if missing:
+            orgs.update(zip((guid for _, guid in missing), await self.__fetch_orgs(missing)))
+        if stale:
+            self.__refresh_in_background(stale)
+        logger.debug(f'Orgs registry: {len(guids)} requested, {len(missing)} fetched, {len(stale)} stale')
+        return [replace(orgs[guid], status=status) for status, guid in guids]
+
+    def __refresh_in_background(self, guids: list[tuple[Literal['УО', 'РСО'], str]]) -> NoReturn:
+        task = self.__start_fetch(guids)
+        if task:
+            task.add_done_callback(self.__log_refresh_error)
+
+    async def __fetch_orgs(self, guids: list[tuple[Literal['УО', 'РСО'], str]]) -> list[Organization]:
+        # an organisation already on its way from the portal, for another house or a background refresh, is
+        # waited for instead of fetched again
+        self.__start_fetch(guids)
+        tasks = {guid: self.__fetching[guid] for _, guid in guids}
+        orgs = {}
+        for task in set(tasks.values()):
+            orgs.update(await asyncio.shield(task))
+        return [orgs[guid] for _, guid in guids]
+
+    def __start_fetch(self, guids: list[tuple[Literal['УО', 'РСО'], str]]) -> Task | None:
+        guids = [(status, guid) for status, guid in guids if guid not in self.__fetching]
+        if not guids:
+            return None
+        task = asyncio.create_task(self.__fetch_batch(guids))
+        for _, guid in guids:
+            self.__fetching[guid] = task
+        task.add_done_callback(lambda _: self.__forget_fetch(guids))
+        return task
+
+    def __forget_fetch(self, guids: list[tuple[Literal['УО', 'РСО'], str]]) -> NoReturn:
+        for _, guid in guids:
+            self.__fetching.pop(guid, None)
+
+    @staticmethod
+    def __log_refresh_error(task: Task) -> NoReturn:
+        if not task.cancelled() and task.exception():
+            logger.opt(exception=task.exception()).warning('Background refresh of orgs failed')
+
+    async def __fetch_batch(self, guids: list[tuple[Literal['УО', 'РСО'], str]]) -> dict[str, Organization]:
+        # orgByGuid has no batch form and is fetched per organisation, additionalinfo takes the whole list
+        unique = [guid for _, guid in guids]
+        data, additional_infos = await asyncio.gather(
+            asyncio.gather(*(self.__get_org_data_by_guid(guid) for guid in unique)),
+            self.__get_additional_infos(unique)
+        )
+        orgs = {}
+        for (status, guid), data_ in zip(guids, data):
+            org = Organization()
+            org.status = status
+            org.link = self.__get_link(guid)
+            await self.__parse_org_data(org, {**data_, 'additional_info': additional_infos.get(guid)})
+            logger.debug(org.chief_name)
+            self.__store(guid, org)
+            orgs[guid] = org
+        return orgs
 
-    async def parse_org_by_guid(self, status: Literal['УО', 'РСО'], guid: str) -> NoReturn:
-        org = Organization()
-        org.status = status
-        org.link = f"https://dom.gosuslugi.ru/#!/organizationView/{guid}"
-        data = await self.__get_org_data_by_guid(guid)
-        await self.__parse_org_data(org, data)
-        await asyncio.sleep(15)
-        logger.debug(org.chief_name)
-        return org
+    @staticmethod
+    def __store(guid: str, org: Organization) -> NoReturn:
+        # the sheet only gets the organisations whose content has changed since the last fetch
+        repository = Repository()
+        writer = SheetsWriter()
+        with writer.journal_lock:
+            stored = repository.find_org_by_link(org.link)
+            if stored:
+                # an organisation serving one house as УО and another as РСО keeps the role it was first
+                # stored with
+                org = replace(org, status=stored[1])
+            row = list(asdict(org).values())
+            hash_ = hashlib.sha256(ujson.dumps(row, ensure_ascii=False).encode()).hexdigest()
+            entry = repository.get_org_registry_entry(guid)
+            repository.save_org_registry_entry(guid, org.inn, hash_, time.time())
+            if stored and (entry and entry[1] == hash_ or stored == row):
+                return
+            repository.save_org(row)
+            if stored:
+                writer.delete(SHEETS[Table.ORGS], KEYS[Table.ORGS][1], org.link)
+            writer.append(SHEETS[Table.ORGS], row)
+        logger.info(f'Org {org.inn} ({guid}) changed')
+
+    @staticmethod
+    def __get_link(guid: str) -> str:
+        return f"https://dom.gosuslugi.ru/#!/organizationView/{guid}"
 
     @staticmethod
     async def find_orgs_by_inns(inns: list[str]) -> list[Organization]:
         orgs = []
-        orgs_sheet = await OrganizationsParser.get_orgs_sheet()
+        repository = Repository()
         for inn in inns:
-            cell = await orgs_sheet.find(inn)
-            row = await orgs_sheet.row_values(cell.row)
-            org = Organization(*row)
-            orgs.append(org)
+            row = repository.find_org_by_inn(inn)
+            if row:
+                orgs.append(Organization(*row))
         logger.info(f"{len(orgs)}/{len(inns)} orgs found")
         return orgs
 
     async def __get_org_data_by_guid(self, guid: str) -> dict:
-        async with self.__session.get(f"{self.__base_org_endpoint_url}/orgByGuid?organizationGuid={guid}") as response:
-            data = await response.json(loads=ujson.loads)
-        async with self.__session.post(f"{self.__base_org_endpoint_url}/additionalinfo",
-                                       json={'organizationGuids': [guid]}) as response:
-            additional_info = await response.json(loads=ujson.loads)
-            data['additional_info'] = additional_info['additionalInfos'][0]
-        return data
+        return await PortalTransport().get_json(f"{self.__base_org_endpoint_url}/orgByGuid?organizationGuid={guid}",
+                                                cache_ttl=PORTAL_ORG_CACHE_TTL, bucket=self.__bucket)
+
+    async def __get_additional_infos(self, guids: list[str]) -> dict[str, dict]:
+        additional_infos = {}
+        for start in range(0, len(guids), ORGS_ADDITIONAL_INFO_BATCH_SIZE):
+            batch = guids[start:start + ORGS_ADDITIONAL_INFO_BATCH_SIZE]
+            infos = (await self.__post_additional_infos(batch)).get('additionalInfos') or []
+            # an info is matched by the guid it carries, by the request order only when it has none and the
+            # portal answered exactly one info per guid, otherwise every guid of the batch is asked for alone
+            info_guids = [info.get('organizationGuid') or info.get('guid') for info in infos]
+            if infos and all(guid in batch for guid in info_guids):
+                additional_infos.update(zip(info_guids, infos))
+            elif len(infos) == len(batch) and not any(info_guids):
+                additional_infos.update(zip(batch, infos))
+            else:
+                logger.warning(f'additionalinfo returned {len(infos)} infos for {len(batch)} orgs, asking one by one')
+                single = await asyncio.gather(*(self.__post_additional_infos([guid]) for guid in batch))
+                for guid, data in zip(batch, single):
+                    additional_infos[guid] = next(iter(data.get('additionalInfos') or []), None)
+        return additional_infos
+
+    async def __post_additional_infos(self, guids: list[str]) -> dict:
+        return await PortalTransport().post_json(f"{self.__base_org_endpoint_url}/additionalinfo",
+                                                 {'organizationGuids': guids}, bucket=self.__bucket)
 
     async def __parse_org_data(self, org: Organization, data: dict) -> NoReturn:
         org.name = self.__parse_name(data)
@@ -99,7 +229,7 @@ class OrganizationsParser(metaclass=Singleton):
         org.chief_position = self.__parse_chief_position(data)
         org.reg_date = self.__parse_reg_date(data)
         org.all_funcs = self.__parse_all_funcs(data)
-        self.__parse_dadata_fields(org)
+        await self.__parse_dadata_fields(org)
 
     @staticmethod
     def __parse_name(data: dict) -> str:
@@ -185,8 +315,8 @@ class OrganizationsParser(metaclass=Singleton):
         return funcs_str.join(funcs_parts)
 
     @staticmethod
-    def __parse_dadata_fields(org: Organization) -> NoReturn:
-        result = get_organization_by_inn(org.inn)
+    async def __parse_dadata_fields(org: Organization) -> NoReturn:
+        result = await get_organization_by_inn(org.inn)
         if result:
             org.state = OrgStatus[result.state['status']].value
             org.short_name = result.short_name
@@ -197,38 +327,3 @@ class OrganizationsParser(metaclass=Singleton):
             if result.emails:
                 org.dadata_email = result.emails[0]
         org.dadata_link = f"https://dadata.ru/find/party/{org.inn}/"
-
-    async def save_orgs_data(self, orgs: list[Organization]) -> NoReturn:
-        orgs_sheet = await self.get_orgs_sheet()
-        data = []
-        for org in orgs:
-            g_org = await self.__find_org_by_link(org.link)
-            if not g_org:
-                data.append(list(asdict(org).values()))
-            elif org != g_org:
-                cell = await orgs_sheet.find(org.inn)
-                await orgs_sheet.delete_row(cell.row)
-                data.append(list(asdict(org).values()))
-        logger.debug(f"{len(data)} orgs to save")
-        if len(data) > 0:
-            logger.info(data)
-            await orgs_sheet.append_rows(values=data)
-
-    @staticmethod
-    async def get_orgs_sheet():
-        agc = await agcm.authorize()
-        sh = await agc.open_by_url(
-            'https://docs.google.com/spreadsheets/d/1kGCdugwpVwuDO5LRC7tOxIkvMt_5iFQlGphLMAL107A/edit#gid=0')
-        orgs_sheet = await sh.worksheet('Организации')
-        return orgs_sheet
-
-    @staticmethod
-    async def __find_org_by_link(link: str) -> Organization | None:
-        orgs_sheet = await OrganizationsParser.get_orgs_sheet()
-        cell = await orgs_sheet.find(link)
-        if not cell:
-            return None
-        else:
-            row = await orgs_sheet.row_values(cell.row)
-            org = Organization(*row)
-            return org
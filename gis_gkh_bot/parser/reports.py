@@ -0,0 +1,135 @@
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict
+from pathlib import Path
+from typing import NoReturn, Callable, Any
+
+import ujson
+from loguru import logger
+
+from .mkd import MKD
+from .organization import Organization
+from .room import Room
+from .utils import BASE_DIR, single_flight
+
+REPORTS_DIR = BASE_DIR / 'reports'
+REPORTS_CACHE_DIR = REPORTS_DIR / 'cache'
+REPORTS_CACHE_MAX_SIZE = int(os.environ.get('REPORTS_CACHE_MAX_SIZE', 500)) * 1024 * 1024
+REPORTS_WORKERS = int(os.environ.get('REPORTS_WORKERS', 2))
+# renders waiting for a free worker on top of the running ones, later ones wait before they are even submitted
+REPORTS_MAX_QUEUED = int(os.environ.get('REPORTS_MAX_QUEUED', 8))
+REPORTS_WORKERS_NICENESS = int(os.environ.get('REPORTS_WORKERS_NICENESS', 10))
+
+# part of every report hash, bump it when the layout of MKDDataSaver changes so the cached workbooks are rebuilt
+REPORT_VERSION = 1
+
+_executor: ProcessPoolExecutor | None = None
+_render_slots = asyncio.Semaphore(REPORTS_WORKERS + REPORTS_MAX_QUEUED)
+
+
+def get_report_path(mkd: MKD) -> Path:
+    return (REPORTS_DIR / f'МКД_{mkd.cad_num}_{mkd.address.replace("/", "_")}.xlsx').resolve()
+
+
+async def get_mkd_report(mkd: MKD, orgs: list[Organization], rooms: list[Room] = None) -> Path:
+    # workbooks are stored under the hash of the data they show, so a house viewed again without changes gets
+    # its report back without a build, and the usual МКД_<cad>_<addr>.xlsx name is a hard link to the cached one
+    data = _get_report_data(mkd, orgs, rooms)
+    hash_ = _hash_report_data(data)
+    cached = REPORTS_CACHE_DIR / f'{hash_}.xlsx'
+    if cached.exists():
+        # the modification time is the last use for the LRU eviction
+        cached.touch()
+        logger.debug(f'Report cache hit: {hash_}')
+    else:
+        await _build_report(hash_, mkd.address, data)
+    path = get_report_path(mkd)
+    _link(cached, path)
+    return path
+
+
+def _get_report_data(mkd: MKD, orgs: list[Organization], rooms: list[Room] | None) -> tuple[dict, list, list]:
+    # the plain form is both hashed and sent to the report worker, so it is made once per report
+    return asdict(mkd), [asdict(org) for org in orgs], [asdict(room) for room in rooms or []]
+
+
+def _hash_report_data(data: tuple[dict, list, list]) -> str:
+    return hashlib.sha256(ujson.dumps([REPORT_VERSION, *data], ensure_ascii=False).encode()).hexdigest()
+
+
+@single_flight(lambda hash_, address, data: hash_)
+async def _build_report(hash_: str, address: str, data: tuple[dict, list, list]) -> NoReturn:
+    REPORTS_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    cached = REPORTS_CACHE_DIR / f'{hash_}.xlsx'
+    # built under a temporary name, so a cached file is always complete
+    building = cached.with_suffix('.tmp')
+    await run_in_report_pool(_render_report, *data, str(building))
+    building.replace(cached)
+    logger.info(f'Report of {address} built: {hash_}')
+    _evict()
+
+
+async def run_in_report_pool(func: Callable[..., Any], *args) -> Any:
+    # CPU-bound workbook builds run in the process pool while the event loop keeps serving updates, past the
+    # running and queued ones further builds wait here instead of piling up in the pool, func and its arguments
+    # are pickled to the worker
+    async with _render_slots:
+        return await asyncio.get_running_loop().run_in_executor(_get_executor(), func, *args)
+
+
+def _render_report(mkd: dict, orgs: list[dict], rooms: list[dict], filepath: str) -> str:
+    # runs in a report worker process, so it takes and returns plain data only, and openpyxl is only ever
+    # loaded by the workers
+    from .saver import MKDDataSaver
+    saver = MKDDataSaver(MKD(**mkd), [Organization(**org) for org in orgs], [Room(**room) for room in rooms])
+    return str(saver.save_mkd_to_excel(Path(filepath)))
+
+
+def _init_worker() -> NoReturn:
+    # renders give way to the bot process, so updates are answered on time even with every worker busy
+    os.nice(REPORTS_WORKERS_NICENESS)
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        # spawned workers do not inherit the event loop, sockets and threads of the bot process
+        _executor = ProcessPoolExecutor(
+            REPORTS_WORKERS, mp_context=multiprocessing.get_context('spawn'), initializer=_init_worker
+        )
+    return _executor
+
+
+def close_report_pool() -> NoReturn:
+    global _executor
+    if _executor:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def _link(cached: Path, path: Path) -> NoReturn:
+    if path.exists() and path.samefile(cached):
+        return
+    # a temporary name of its own for every call, concurrent links of the same house do not collide
+    linking = path.with_name(f'{path.stem}.{uuid.uuid4().hex}.link')
+    os.link(cached, linking)
+    try:
+        linking.replace(path)
+    finally:
+        linking.unlink(missing_ok=True)
+
+
+def _evict() -> NoReturn:
+    # least recently used workbooks go first, the one just built always stays, and a named link keeps its file
+    # until the next build of that house
+    files = sorted(REPORTS_CACHE_DIR.glob('*.xlsx'), key=lambda file: file.stat().st_mtime, reverse=True)
+    size = files[0].stat().st_size
+    for file in files[1:]:
+        size += file.stat().st_size
+        if size > REPORTS_CACHE_MAX_SIZE:
+            file.unlink(missing_ok=True)
+            logger.info(f'Report {file.name} evicted from the cache')
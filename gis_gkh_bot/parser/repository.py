@@ -0,0 +1,167 @@
+import os
+import sqlite3
+from enum import StrEnum
+from typing import NoReturn, Iterable, Iterator
+
+import ujson
+
+from .utils import Singleton, BASE_DIR
+
+REPOSITORY_PATH = os.environ.get('REPOSITORY_PATH', str(BASE_DIR / 'storage.sqlite3'))
+# rows read per query by iter_rows, no read transaction is held between the pages
+REPOSITORY_PAGE_SIZE = int(os.environ.get('REPOSITORY_PAGE_SIZE', 1_000))
+
+
+class Table(StrEnum):
+    MKDS = 'mkds'
+    ORGS = 'orgs'
+    ROOMS = 'rooms'
+
+
+# worksheet title and positions of the two indexed columns of every stored row
+SHEETS = {
+    Table.MKDS: 'МКД',
+    Table.ORGS: 'Организации',
+    Table.ROOMS: 'Помещения',
+}
+KEYS = {
+    Table.MKDS: (0, 10),  # id, card_link
+    Table.ORGS: (0, 13),  # inn, link
+    Table.ROOMS: (0, 1),  # id, mkd_id
+}
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS mkds (id TEXT, card_link TEXT, row TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS mkds_id ON mkds (id);
+CREATE INDEX IF NOT EXISTS mkds_card_link ON mkds (card_link);
+
+CREATE TABLE IF NOT EXISTS orgs (inn TEXT, link TEXT, row TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS orgs_inn ON orgs (inn);
+CREATE INDEX IF NOT EXISTS orgs_link ON orgs (link);
+
+CREATE TABLE IF NOT EXISTS org_registry (
+    guid TEXT PRIMARY KEY, inn TEXT, hash TEXT NOT NULL, updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS org_registry_inn ON org_registry (inn);
+
+CREATE TABLE IF NOT EXISTS rooms (id TEXT, mkd_id TEXT, row TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS rooms_id ON rooms (id);
+CREATE INDEX IF NOT EXISTS rooms_mkd_id ON rooms (mkd_id);
+
+CREATE TABLE IF NOT EXISTS pending_writes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, title TEXT NOT NULL, operation TEXT NOT NULL, payload TEXT NOT NULL
+);
+'''
+
+
+class Repository(metaclass=Singleton):
+    def __init__(self, path: str = REPOSITORY_PATH):
+        self.__connection = sqlite3.connect(path, check_same_thread=False)
+        # readers in other processes such as the export do not block the writes of the bot and the other way round
+        self.__connection.execute('PRAGMA journal_mode=WAL')
+        self.__connection.executescript(SCHEMA)
+
+    def find_mkd_by_link(self, link: str) -> list | None:
+        return self.__fetch_one('SELECT row FROM mkds WHERE card_link = ?', link)
+
+    def find_mkd_by_id(self, id_: str) -> list | None:
+        return self.__fetch_one('SELECT row FROM mkds WHERE id = ?', id_)
+
+    def get_all_mkds(self) -> list[list]:
+        return self.__fetch_all('SELECT row FROM mkds ORDER BY rowid')
+
+    def save_mkd(self, row: list) -> NoReturn:
+        with self.__connection:
+            self.__connection.execute('DELETE FROM mkds WHERE card_link = ?', (row[KEYS[Table.MKDS][1]],))
+            self.__insert(Table.MKDS, [row])
+
+    def find_org_by_link(self, link: str) -> list | None:
+        return self.__fetch_one('SELECT row FROM orgs WHERE link = ?', link)
+
+    def find_org_by_inn(self, inn: str) -> list | None:
+        return self.__fetch_one('SELECT row FROM orgs WHERE inn = ?', inn)
+
+    def save_org(self, row: list) -> NoReturn:
+        with self.__connection:
+            self.__connection.execute('DELETE FROM orgs WHERE link = ?', (row[KEYS[Table.ORGS][1]],))
+            self.__insert(Table.ORGS, [row])
+
+    def get_org_registry_entry(self, guid: str) -> tuple[str, str, float] | None:
+        # inn, content hash and time of the last fetch from the portal
+        return self.__connection.execute(
+            'SELECT inn, hash, updated_at FROM org_registry WHERE guid = ?', (guid,)
+        ).fetchone()
+
+    def save_org_registry_entry(self, guid: str, inn: str, hash_: str, updated_at: float) -> NoReturn:
+        with self.__connection:
+            self.__connection.execute(
+                'INSERT OR REPLACE INTO org_registry VALUES (?, ?, ?, ?)', (guid, inn, hash_, updated_at)
+            )
+
+    def find_rooms_by_mkd_id(self, mkd_id: str) -> list[list]:
+        return self.__fetch_all('SELECT row FROM rooms WHERE mkd_id = ? ORDER BY rowid', mkd_id)
+
+    def mkd_has_rooms(self, mkd_id: str) -> bool:
+        return self.__fetch_one('SELECT row FROM rooms WHERE mkd_id = ? LIMIT 1', mkd_id) is not None
+
+    def delete_rooms_by_mkd_id(self, mkd_id: str) -> NoReturn:
+        with self.__connection:
+            self.__connection.execute('DELETE FROM rooms WHERE mkd_id = ?', (mkd_id,))
+
+    def save_room(self, row: list) -> NoReturn:
+        with self.__connection:
+            self.__insert(Table.ROOMS, [row])
+
+    def add_pending_write(self, title: str, operation: str, payload: list) -> NoReturn:
+        with self.__connection:
+            self.__connection.execute(
+                'INSERT INTO pending_writes (title, operation, payload) VALUES (?, ?, ?)',
+                (title, operation, ujson.dumps(payload, ensure_ascii=False))
+            )
+
+    def get_pending_writes(self) -> list[tuple[int, str, str, list]]:
+        return [
+            (id_, title, operation, ujson.loads(payload)) for id_, title, operation, payload in
+            self.__connection.execute('SELECT id, title, operation, payload FROM pending_writes ORDER BY id')
+        ]
+
+    def get_pending_write_titles(self) -> set[str]:
+        return {title for title, in self.__connection.execute('SELECT DISTINCT title FROM pending_writes')}
+
+    def count_pending_writes(self) -> int:
+        return self.__connection.execute('SELECT COUNT(*) FROM pending_writes').fetchone()[0]
+
+    def delete_pending_writes(self, title: str, last_id: int) -> NoReturn:
+        with self.__connection:
+            self.__connection.execute('DELETE FROM pending_writes WHERE title = ? AND id <= ?', (title, last_id))
+
+    def iter_rows(self, table: Table) -> Iterator[list]:
+        # keyset pages, a whole table is never held in memory and every page is a short read of its own, so a long
+        # export does not keep a read transaction open under the writers
+        last = 0
+        while page := self.__connection.execute(
+                f'SELECT rowid, row FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?', (last, REPOSITORY_PAGE_SIZE)
+        ).fetchall():
+            last = page[-1][0]
+            for _, row in page:
+                yield ujson.loads(row)
+
+    def replace_rows(self, table: Table, rows: Iterable[list]) -> NoReturn:
+        with self.__connection:
+            self.__connection.execute(f'DELETE FROM {table}')
+            self.__insert(table, (row for row in rows if any(row)))
+
+    def __insert(self, table: Table, rows: Iterable[list]) -> NoReturn:
+        first, second = KEYS[table]
+        self.__connection.executemany(
+            f'INSERT INTO {table} VALUES (?, ?, ?)',
+            ((str(row[first]), str(row[second]), ujson.dumps(row, ensure_ascii=False)) for row in rows)
+        )
+
+    def __fetch_one(self, query: str, *params) -> list | None:
+        result = self.__connection.execute(query, params).fetchone()
+        return ujson.loads(result[0]) if result else None
+
+    def __fetch_all(self, query: str, *params) -> list[list]:
+        return [ujson.loads(result[0]) for result in self.__connection.execute(query, params)]
+
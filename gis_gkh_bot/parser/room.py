@@ -1,21 +1,31 @@
 import asyncio
+import os
 from dataclasses import dataclass, field, asdict
 from typing import NoReturn, Literal
 
-import ujson
-from aiohttp import ClientSession
 from httpx import HTTPStatusError
 from jmespath import search
 from loguru import logger
 
-from dadata_wrapper.dadataapi import get_address_data, get_address_data_by_id
-from .utils import Singleton, extract_digits_from_string, agcm
+from dadata_wrapper.dadataapi import get_addresses_data, get_address_data_by_id, get_dadata_cache, AddressData, \
+    DADATA_BATCH_SIZE
+from .checkpoint import CrawlCheckpoints
+from .limiter import TokenBucket, portal_controller
+from .repository import Repository, Table, SHEETS, KEYS
+from .transport import PortalTransport
+from .utils import Singleton, extract_digits_from_string
+from .writer import SheetsWriter
+
+# rooms fetched at once by every crawl, the crawls share only the rate bucket and the portal concurrency window
+ROOMS_CONCURRENCY = int(os.environ.get('ROOMS_CONCURRENCY', 4))
+ROOMS_RPS = float(os.environ.get('ROOMS_RPS', 1))
+PORTAL_PASSPORT_CACHE_TTL = float(os.environ.get('PORTAL_PASSPORT_CACHE_TTL', 24 * 60 * 60))
+PORTAL_ROOM_CACHE_TTL = float(os.environ.get('PORTAL_ROOM_CACHE_TTL', 24 * 60 * 60))
 
 HEADERS = {
     'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:109.0) Gecko/20100101 Firefox/114.0',
     'Accept': 'application/json; charset=utf-8',
     'Accept-Language': 'ru-RU,ru;q=0.8,en-US;q=0.5,en;q=0.3',
-    # 'Accept-Encoding': 'gzip, deflate, br',
     'Content-Type': 'application/json;charset=utf-8',
     'Session-GUID': 'd07f811f-d71f-4012-b1ae-70423a292620',
     'State-GUID': '/passport/show',
@@ -71,23 +81,30 @@ class Room:
 
 
 class RoomsParser(metaclass=Singleton):
-    def __init__(self, session: ClientSession):
-        self.__session = session
+    def __init__(self):
         self.__endpoint_url = 'https://dom.gosuslugi.ru/homemanagement/api/rest/services/passports/search'
         self.__endpoint_data = {"page": 1, "itemsPerPage": 500}
-        self.is_running = False
-        self.stopped = False
-
-    async def parse_mkd_rooms_by_guid(self, guid: str, mkd):
-        self.is_running = True
-        if not self.__session:
-            self.__session = ClientSession()
-        data = await self.__get_rooms_data_by_guid(guid)
-        rooms = await self.__collect_rooms(data, mkd, guid)
-        self.is_running = False
+        # ids of the MKDs whose crawls are paused until the user confirms or declines the cancel
+        self.paused: set[str] = set()
+        self.__bucket = TokenBucket(ROOMS_RPS * 60, 1)
+
+    async def parse_mkd_rooms_by_guid(self, guid: str, mkd, chat_id: int = None):
+        checkpoints = CrawlCheckpoints()
+        checkpoint = await checkpoints.get(guid)
+        if checkpoint:
+            items = checkpoint.remaining
+            logger.info(f'Resuming rooms crawl of {guid}: {checkpoint.completed} done, {len(items)} left')
+        else:
+            data = await self.__get_rooms_data_by_guid(guid)
+            items = [{'status': 'КВ', **item} for item in data.get('residential')]
+            items.extend({'status': 'НЖ', **item} for item in data.get('non_residential'))
+            await checkpoints.start(guid, mkd.id, chat_id, items)
+        rooms = await self.__collect_rooms(items, mkd, guid)
+        await SheetsWriter().flush()
+        await checkpoints.finish(guid)
         return rooms
 
-    async def __collect_rooms(self, data: dict[str, list[dict]], mkd, guid: str) -> list[Room]:
+    async def __collect_rooms(self, items: list[dict], mkd, guid: str) -> list[Room]:
         logger.debug('parse rooms')
         rooms_ = []
         rooms = await self.find_rooms_by_mkd_id(mkd.id)
@@ -97,41 +114,67 @@ class RoomsParser(metaclass=Singleton):
             non_res_rooms = [room.number for room in rooms if room.status != 'КВ']
         else:
             res_rooms, non_res_rooms = [], []
-        for item in data.get('residential'):
-            while self.stopped:
-                await asyncio.sleep(5)
-            number = item.get('value')
-            if number not in res_rooms:
-                room = await self.__parse_room(item, mkd, 'КВ', guid)
-                rooms_.append(room)
-                logger.debug('Sleep')
-                await asyncio.sleep(10)
-        for item in data.get('non_residential'):
-            while self.stopped:
-                await asyncio.sleep(5)
-            number = item.get('value')
-            if number not in non_res_rooms:
-                room = await self.__parse_room(item, mkd, 'НЖ', guid)
-                rooms_.append(room)
-                logger.debug('Sleep')
-                await asyncio.sleep(10)
-
+        items = [
+            item for item in items
+            if item.get('value') not in (res_rooms if item['status'] == 'КВ' else non_res_rooms)
+        ]
+        checkpoints = CrawlCheckpoints()
+        fetched: list[Room | None] = [None] * len(items)
+        saved = 0
+        save_lock = asyncio.Lock()
+        pending = iter(enumerate(items))
+
+        async def fetch_rooms() -> NoReturn:
+            # a worker of this crawl only, a paused or long crawl never holds up the others
+            while True:
+                while mkd.id in self.paused:
+                    await asyncio.sleep(5)
+                if (next_item := next(pending, None)) is None:
+                    return
+                index, item = next_item
+                fetched[index] = await self.__parse_room(item, mkd, item['status'], guid)
+                # while another worker saves, it picks this room up itself and this worker goes on fetching
+                if not save_lock.locked():
+                    await save_rooms()
+
+        async def save_rooms() -> NoReturn:
+            nonlocal saved
+            # rooms are resolved in DaData and saved in the portal order, a batch at a time once every room before
+            # them is fetched, and only saved rooms leave the checkpoint
+            async with save_lock:
+                while True:
+                    ready = 0
+                    while saved + ready < len(fetched) and ready < DADATA_BATCH_SIZE and fetched[saved + ready]:
+                        ready += 1
+                    # a short batch waits for more rooms unless it is the tail of the crawl
+                    if not ready or (ready < DADATA_BATCH_SIZE and saved + ready < len(fetched)):
+                        break
+                    await self.__parse_dadata_fields(fetched[saved:saved + ready])
+                    for position in range(saved, saved + ready):
+                        await self.__save_room(fetched[position])
+                        await checkpoints.complete(guid, items[position]['paramCode'])
+                    saved += ready
+
+        async with asyncio.TaskGroup() as group:
+            for _ in range(min(ROOMS_CONCURRENCY, len(items))):
+                group.create_task(fetch_rooms())
+        rooms_.extend(fetched)
+        logger.info(f'Fetched {len(fetched)} rooms, portal concurrency: {portal_controller.stats}, '
+                    f'portal cache: {PortalTransport().stats}, DaData cache: {get_dadata_cache().stats}')
         return rooms_
 
     async def __get_rooms_data_by_guid(self, guid: str) -> dict[str, list[dict]]:
         data = {}
-        async with self.__session.post(self.__endpoint_url, headers=HEADERS,
-                                       json={"houseGuid": guid, 'passportParameterCode': "17",
-                                             **self.__endpoint_data}) as response:
-            res_data = await response.json(loads=ujson.loads)
-            res_data_params = res_data.get('parameters')
-            data['residential'] = res_data_params
-        async with self.__session.post(self.__endpoint_url, headers=HEADERS,
-                                       json={"houseGuid": guid, 'passportParameterCode': "18",
-                                             **self.__endpoint_data}) as response:
-            non_res_data = await response.json(loads=ujson.loads)
-            non_res_data_params = non_res_data.get('parameters')
-            data['non_residential'] = non_res_data_params
+        res_data = await PortalTransport().post_json(
+            self.__endpoint_url, {"houseGuid": guid, 'passportParameterCode': "17", **self.__endpoint_data},
+            cache_ttl=PORTAL_PASSPORT_CACHE_TTL, headers=HEADERS
+        )
+        data['residential'] = res_data.get('parameters')
+        non_res_data = await PortalTransport().post_json(
+            self.__endpoint_url, {"houseGuid": guid, 'passportParameterCode': "18", **self.__endpoint_data},
+            cache_ttl=PORTAL_PASSPORT_CACHE_TTL, headers=HEADERS
+        )
+        data['non_residential'] = non_res_data.get('parameters')
         return data
 
     async def __parse_room(self, item: dict, mkd, status: Literal['КВ', 'НЖ'], guid: str) -> Room:
@@ -141,16 +184,14 @@ class RoomsParser(metaclass=Singleton):
         return room
 
     async def __get_room_params(self, room: Room, param_code: str, house_guid: str, mkd_addr: str) -> NoReturn:
-        async with self.__session.post(self.__endpoint_url, headers=HEADERS, cookies=cookies,
-                                       json={"houseGuid": house_guid, 'passportParameterCode': param_code,
-                                             **self.__endpoint_data}) as response:
-            logger.debug(response.status)
-            data = await response.json(loads=ujson.loads)
-            if room.status == 'КВ':
-                await self.__parse_residential_room(mkd_addr, room, data)
-            else:
-                await self.__parse_non_residential_room(mkd_addr, room, data)
-            await self.__save_room(room)
+        data = await PortalTransport().post_json(
+            self.__endpoint_url, {"houseGuid": house_guid, 'passportParameterCode': param_code, **self.__endpoint_data},
+            cache_ttl=PORTAL_ROOM_CACHE_TTL, bucket=self.__bucket, headers=HEADERS, cookies=cookies
+        )
+        if room.status == 'КВ':
+            await self.__parse_residential_room(mkd_addr, room, data)
+        else:
+            await self.__parse_non_residential_room(mkd_addr, room, data)
 
     async def __parse_residential_room(self, mkd_addr: str, room: Room, data: list[dict]) -> NoReturn:
         room.cad_num = self.__parse_cad_num(data)
@@ -163,8 +204,6 @@ class RoomsParser(metaclass=Singleton):
         room.total_area = self.__parse_total_square(data)
         room.entrance_number = self.__parse_entrance_number(data)
         room.address = self.__parse_address(mkd_addr, room)
-        self.__parse_dadata_fields(room)
-        logger.debug(room.dadata_cad_num)
 
     async def __parse_non_residential_room(self, mkd_addr: str, room: Room, data: list[dict]) -> NoReturn:
         room.cad_num = self.__parse_cad_num(data)
@@ -174,8 +213,6 @@ class RoomsParser(metaclass=Singleton):
         room.total_area = self.__parse_total_square(data)
         room.status = self.__parse_status(data)
         room.address = self.__parse_address(mkd_addr, room)
-        self.__parse_dadata_fields(room)
-        logger.debug(room.dadata_cad_num)
 
     @staticmethod
     def __parse_cad_num(data: list[dict]) -> str:
@@ -236,67 +273,67 @@ class RoomsParser(metaclass=Singleton):
         else:
             return f"{mkd_addr}, кв.{room.number}"
 
-    @staticmethod
-    def __parse_dadata_fields(room: Room) -> NoReturn:
+    @classmethod
+    async def __parse_dadata_fields(cls, rooms: list[Room]) -> NoReturn:
+        # findById has no batch form, so cadastral numbers are looked up concurrently, and the rooms without one or
+        # not found by it go to the batch cleaner together
+        results: list[AddressData | Exception | None] = [None] * len(rooms)
+        by_cad_num = [bool(room.cad_num) for room in rooms]
+        indexes = [index for index, room in enumerate(rooms) if room.cad_num]
+        found = await asyncio.gather(*(get_address_data_by_id(rooms[index].cad_num) for index in indexes),
+                                     return_exceptions=True)
+        for index, result in zip(indexes, found):
+            results[index] = result
+            by_cad_num[index] = result is not None
+        indexes = [index for index, result in enumerate(results) if result is None]
         try:
-            if room.cad_num:
-                result = get_address_data_by_id(room.cad_num)
-                if result is None:
-                    result = get_address_data(room.address)
-                    room.fias_gar_code = result.fias_id
-                else:
-                    room.fias_gar_code = result.flat_fias_id
-            else:
-                result = get_address_data(room.address)
-                room.fias_gar_code = result.fias_id
+            cleaned = await get_addresses_data([rooms[index].address for index in indexes])
+        except HTTPStatusError as ex:
+            cleaned = [ex] * len(indexes)
+        for index, result in zip(indexes, cleaned):
+            results[index] = result
+        for room, result, is_by_cad_num in zip(rooms, results, by_cad_num):
+            if result is None or isinstance(result, HTTPStatusError):
+                cls.__set_dadata_error_fields(room)
+                continue
+            if isinstance(result, Exception):
+                raise result
+            room.fias_gar_code = result.flat_fias_id if is_by_cad_num else result.fias_id
             room.dadata_area = float(result.flat_area) if result.flat_area else None
             room.floor = result.fias_level
             room.dadata_number = result.flat
             room.dadata_cad_num = result.flat_cadnum
             if result.house_cadnum:
                 room.dadata_mkd_id = result.house_cadnum.replace(':', '')
-        except HTTPStatusError:
-            room.fias_gar_code = 'ОШИБКА'
-            room.dadata_area = 'ОШИБКА'
-            room.floor = 'ОШИБКА'
-            room.dadata_number = 'ОШИБКА'
-            room.dadata_cad_num = 'ОШИБКА'
-            room.dadata_mkd_id = 'ОШИБКА'
+
+    @staticmethod
+    def __set_dadata_error_fields(room: Room) -> NoReturn:
+        room.fias_gar_code = 'ОШИБКА'
+        room.dadata_area = 'ОШИБКА'
+        room.floor = 'ОШИБКА'
+        room.dadata_number = 'ОШИБКА'
+        room.dadata_cad_num = 'ОШИБКА'
+        room.dadata_mkd_id = 'ОШИБКА'
 
     @staticmethod
     async def find_rooms_by_mkd_id(mkd_id: str) -> list[Room]:
-        rooms = []
-        rooms_sheet = await RoomsParser.__get_rooms_sheet()
-        cells = await rooms_sheet.findall(mkd_id)
-        for cell in cells:
-            row = await rooms_sheet.row_values(cell.row)
-            room = Room(*row)
-            rooms.append(room)
-        return rooms
+        return [Room(*row) for row in Repository().find_rooms_by_mkd_id(mkd_id)]
 
     @staticmethod
     async def mkd_has_rooms(mkd_id: str) -> bool:
-        rooms_sheet = await RoomsParser.__get_rooms_sheet()
-        cells = await rooms_sheet.findall(mkd_id)
-        return bool(cells)
+        return Repository().mkd_has_rooms(mkd_id)
 
     @staticmethod
     async def delete_rooms_by_mkd_id(mkd_id: str) -> None:
-        rooms_sheet = await RoomsParser.__get_rooms_sheet()
-        cells = await rooms_sheet.findall(mkd_id)
-        if cells:
-            logger.info(f'Delete {cells[0].row} - {cells[-1].row} rows')
-            await rooms_sheet.delete_rows(cells[0].row, cells[-1].row)
+        writer = SheetsWriter()
+        with writer.journal_lock:
+            Repository().delete_rooms_by_mkd_id(mkd_id)
+            writer.delete(SHEETS[Table.ROOMS], KEYS[Table.ROOMS][1], mkd_id)
 
     async def __save_room(self, room: Room) -> NoReturn:
-        data = asdict(room)
-        rooms_sheet = await self.__get_rooms_sheet()
-        await rooms_sheet.append_row(values=list(data.values()))
+        row = list(asdict(room).values())
+        writer = SheetsWriter()
+        with writer.journal_lock:
+            Repository().save_room(row)
+            writer.append(SHEETS[Table.ROOMS], row)
         logger.info(f'Saved {room.cad_num} room')
-
-    @staticmethod
-    async def __get_rooms_sheet():
-        agc = await agcm.authorize()
-        sh = await agc.open_by_url('https://docs.google.com/spreadsheets/d/1kGCdugwpVwuDO5LRC7tOxIkvMt_5iFQlGphLMAL107A/edit#gid=0')
-        rooms_sheet = await sh.worksheet('Помещения')
-        return rooms_sheet
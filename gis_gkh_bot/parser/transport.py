@@ -0,0 +1,205 @@
+import hashlib
+import os
+import time
+from dataclasses import dataclass
+from enum import StrEnum
+from importlib.util import find_spec
+from typing import Any, NoReturn, Mapping
+
+import httpx
+import ujson
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+from loguru import logger
+from redis.exceptions import RedisError
+
+from .limiter import TokenBucket, AIMDController, portal_controller
+from .utils import Singleton, get_redis
+
+PORTAL_CONNECTIONS = int(os.environ.get('PORTAL_CONNECTIONS', 100))
+PORTAL_CONNECTIONS_PER_HOST = int(os.environ.get('PORTAL_CONNECTIONS_PER_HOST', 16))
+PORTAL_DNS_CACHE_TTL = int(os.environ.get('PORTAL_DNS_CACHE_TTL', 300))
+PORTAL_KEEPALIVE_TIMEOUT = float(os.environ.get('PORTAL_KEEPALIVE_TIMEOUT', 60))
+PORTAL_TIMEOUT = float(os.environ.get('PORTAL_TIMEOUT', 60))
+PORTAL_CONNECT_TIMEOUT = float(os.environ.get('PORTAL_CONNECT_TIMEOUT', 10))
+# cached responses older than their TTL are kept this long to be revalidated with ETag or Last-Modified
+PORTAL_CACHE_STALE_TTL = int(os.environ.get('PORTAL_CACHE_STALE_TTL', 30 * 24 * 60 * 60))
+
+
+class Backend(StrEnum):
+    AIOHTTP = 'aiohttp'
+    HTTPX = 'httpx'
+
+
+PORTAL_BACKEND = Backend(os.environ.get('PORTAL_BACKEND', Backend.AIOHTTP))
+
+# aiohttp only decodes brotli when one of the brotli packages is installed
+ACCEPT_ENCODING = 'gzip, deflate, br' if find_spec('brotli') or find_spec('brotlicffi') else 'gzip, deflate'
+# HTTP/2 in httpx needs the h2 package, pip install httpx[http2]
+HTTP2_AVAILABLE = find_spec('h2') is not None
+
+
+@dataclass
+class PortalResponse:
+    status: int
+    headers: Mapping[str, str]
+    data: Any
+
+
+class AiohttpBackend:
+    def __init__(self, controller: AIMDController = portal_controller):
+        self.__controller = controller
+        self.__session: ClientSession | None = None
+
+    @property
+    def session(self) -> ClientSession:
+        # created on first use, a ClientSession has to be made inside the running event loop
+        if self.__session is None or self.__session.closed:
+            connector = TCPConnector(
+                limit=PORTAL_CONNECTIONS, limit_per_host=PORTAL_CONNECTIONS_PER_HOST,
+                ttl_dns_cache=PORTAL_DNS_CACHE_TTL, keepalive_timeout=PORTAL_KEEPALIVE_TIMEOUT,
+                enable_cleanup_closed=True
+            )
+            self.__session = ClientSession(
+                connector=connector, timeout=ClientTimeout(total=PORTAL_TIMEOUT, connect=PORTAL_CONNECT_TIMEOUT),
+                headers={'Accept-Encoding': ACCEPT_ENCODING}, json_serialize=ujson.dumps, trust_env=True
+            )
+        return self.__session
+
+    async def request(self, method: str, url: str, **kwargs) -> PortalResponse:
+        async with self.__controller.request(self.session.request, method, url, **kwargs) as response:
+            data = await response.json(loads=ujson.loads) if response.status != 304 else None
+            return PortalResponse(response.status, response.headers, data)
+
+    async def close(self) -> NoReturn:
+        if self.__session and not self.__session.closed:
+            await self.__session.close()
+        self.__session = None
+
+
+class HttpxBackend:
+    # the many concurrent room parameter requests share a few multiplexed HTTP/2 connections instead of
+    # one HTTP/1.1 connection each
+    def __init__(self, http2: bool = True, controller: AIMDController = portal_controller):
+        self.__controller = controller
+        if http2 and not HTTP2_AVAILABLE:
+            logger.warning('h2 is not installed, the httpx portal backend falls back to HTTP/1.1')
+        self.__http2 = http2 and HTTP2_AVAILABLE
+        self.__client: httpx.AsyncClient | None = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self.__client is None or self.__client.is_closed:
+            self.__client = httpx.AsyncClient(
+                http2=self.__http2, trust_env=True,
+                limits=httpx.Limits(max_connections=PORTAL_CONNECTIONS,
+                                    max_keepalive_connections=PORTAL_CONNECTIONS_PER_HOST,
+                                    keepalive_expiry=PORTAL_KEEPALIVE_TIMEOUT),
+                timeout=httpx.Timeout(PORTAL_TIMEOUT, connect=PORTAL_CONNECT_TIMEOUT)
+            )
+        return self.__client
+
+    async def request(self, method: str, url: str, **kwargs) -> PortalResponse:
+        # httpx has no per-request cookies, they travel in the Cookie header like in the browser
+        if cookies := kwargs.pop('cookies', None):
+            cookie = '; '.join(f'{name}={value}' for name, value in cookies.items())
+            kwargs['headers'] = {'Cookie': cookie, **kwargs.get('headers', {})}
+        async with self.__controller.request(self.client.stream, method, url, **kwargs) as response:
+            await response.aread()
+            data = ujson.loads(response.content) if response.status_code != 304 else None
+            return PortalResponse(response.status_code, response.headers, data)
+
+    async def close(self) -> NoReturn:
+        if self.__client and not self.__client.is_closed:
+            await self.__client.aclose()
+        self.__client = None
+
+
+BACKENDS = {
+    Backend.AIOHTTP: AiohttpBackend,
+    Backend.HTTPX: HttpxBackend,
+}
+
+
+class PortalTransport(metaclass=Singleton):
+    # the one HTTP client of MKDParser, OrganizationsParser and RoomsParser, every call goes through
+    # portal_controller so the connection pool and the concurrency window are tuned in one place
+    def __init__(self):
+        self.__backend = BACKENDS[PORTAL_BACKEND]()
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        logger.info(f'Portal transport backend: {PORTAL_BACKEND}')
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {'hits': self.hits, 'revalidated': self.revalidated, 'misses': self.misses}
+
+    async def get_json(self, url: str, cache_ttl: float = None, bucket: TokenBucket = None, **kwargs) -> Any:
+        return await self.__request('GET', url, cache_ttl, bucket, **kwargs)
+
+    async def post_json(self, url: str, json: Any, cache_ttl: float = None, bucket: TokenBucket = None,
+                        **kwargs) -> Any:
+        return await self.__request('POST', url, cache_ttl, bucket, json=json, **kwargs)
+
+    async def close(self) -> NoReturn:
+        await self.__backend.close()
+        logger.info(f'Portal transport closed, cache: {self.stats}')
+
+    async def __request(self, method: str, url: str, cache_ttl: float | None, bucket: TokenBucket | None,
+                        **kwargs) -> Any:
+        # responses with a cache_ttl are shared by every worker through Redis, fresh ones are served without a
+        # request and stale ones are sent back to the portal as a conditional request, the caller's rate bucket
+        # is only charged for the requests that actually go out
+        if not cache_ttl:
+            if bucket:
+                await bucket.acquire()
+            return (await self.__backend.request(method, url, **kwargs)).data
+        key = self.__get_cache_key(method, url, kwargs.get('json'))
+        entry = await self.__get_cached(key)
+        if entry and time.time() - float(entry['fetched_at']) < cache_ttl:
+            self.hits += 1
+            return ujson.loads(entry['body'])
+        headers = dict(kwargs.pop('headers', None) or {})
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        if bucket:
+            await bucket.acquire()
+        response = await self.__backend.request(method, url, headers=headers, **kwargs)
+        if response.status == 304 and entry:
+            self.revalidated += 1
+            await self.__set_cached(key, entry)
+            return ujson.loads(entry['body'])
+        self.misses += 1
+        if response.status == 200:
+            await self.__set_cached(key, {
+                'body': ujson.dumps(response.data, ensure_ascii=False),
+                'etag': response.headers.get('ETag', ''),
+                'last_modified': response.headers.get('Last-Modified', ''),
+            })
+        return response.data
+
+    @staticmethod
+    def __get_cache_key(method: str, url: str, body: Any) -> str:
+        request = ujson.dumps([method, url, body], ensure_ascii=False, sort_keys=True)
+        return f'portal:{hashlib.sha256(request.encode()).hexdigest()}'
+
+    @staticmethod
+    async def __get_cached(key: str) -> dict[str, str] | None:
+        # the cache only saves requests, the portal is asked directly while Redis is unavailable
+        try:
+            return await get_redis().hgetall(key) or None
+        except RedisError as ex:
+            logger.warning(f'Portal cache read failed: {ex}')
+            return None
+
+    @staticmethod
+    async def __set_cached(key: str, entry: dict[str, str]) -> NoReturn:
+        try:
+            async with get_redis().pipeline() as pipe:
+                pipe.hset(key, mapping={**entry, 'fetched_at': time.time()})
+                pipe.expire(key, PORTAL_CACHE_STALE_TTL)
+                await pipe.execute()
+        except RedisError as ex:
+            logger.warning(f'Portal cache write failed: {ex}')
@@ -1,19 +1,65 @@
+import asyncio
+import functools
+import os
 from pathlib import Path
+from typing import NoReturn, Callable, Hashable, Awaitable, Any
 
+import gspread
 import gspread_asyncio
-import pygsheets
+import requests
 from aiohttp import ClientSession
 from bs4 import BeautifulSoup as soup, SoupStrainer
 from google.oauth2.service_account import Credentials
-from pygsheets import Worksheet
+from loguru import logger
+from redis.asyncio import Redis
+from redis.asyncio.utils import from_url
+
+from .limiter import TokenBucket, sheets_lane, get_backoff_delay
 
 BASE_DIR = Path(__file__).parent.parent.resolve()
+SPREADSHEET_URL = 'https://docs.google.com/spreadsheets/d/1kGCdugwpVwuDO5LRC7tOxIkvMt_5iFQlGphLMAL107A/edit#gid=0'
+
+REDIS_HOST = os.environ.get('REDIS_HOST')
+
+SHEETS_READ_QUOTA = float(os.environ.get('SHEETS_READ_QUOTA', 60))
+SHEETS_WRITE_QUOTA = float(os.environ.get('SHEETS_WRITE_QUOTA', 60))
+SHEETS_BURST = float(os.environ.get('SHEETS_BURST', 10))
+SHEETS_MAX_RETRIES = int(os.environ.get('SHEETS_MAX_RETRIES', 6))
+SHEETS_BACKOFF_BASE = float(os.environ.get('SHEETS_BACKOFF_BASE', 1))
+SHEETS_BACKOFF_MAX = float(os.environ.get('SHEETS_BACKOFF_MAX', 64))
 
 
 def extract_digits_from_string(string: str) -> str:
     return ''.join((char for char in string if char.isdigit()))
 
 
+@functools.cache
+def get_redis() -> Redis:
+    return from_url(REDIS_HOST, decode_responses=True)
+
+
+def single_flight(key: Callable[..., Hashable]) -> Callable:
+    # concurrent calls with the same key share one in-flight task, a cancelled caller leaves it to the others
+    def decorator(func: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+        calls: dict[Hashable, asyncio.Task] = {}
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs) -> Any:
+            key_ = key(*args, **kwargs)
+            task = calls.get(key_)
+            if task is None:
+                task = asyncio.create_task(func(*args, **kwargs))
+                calls[key_] = task
+                task.add_done_callback(lambda _: calls.pop(key_, None))
+            else:
+                logger.debug(f'{func.__qualname__} joined the in-flight call for {key_}')
+            return await asyncio.shield(task)
+
+        return wrapper
+
+    return decorator
+
+
 async def get_page_soup(session: ClientSession, link: str) -> soup:
     async with session.get(link) as response:
         return soup(await response.text(), features='lxml', parse_only=SoupStrainer('body'))
@@ -34,16 +80,78 @@ def get_creds():
     return scoped
 
 
+WRITE_METHODS = frozenset((
+    'append_row', 'append_rows', 'batch_update', 'clear', 'delete_dimension', 'delete_row', 'delete_rows',
+    'insert_row', 'insert_rows', 'update', 'update_cell', 'update_cells', 'values_append', 'values_clear',
+    'values_update',
+))
+
+
+class GspreadClientManager(gspread_asyncio.AsyncioGspreadClientManager):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # titles of the worksheets written since the last SheetsMirror refresh, None if unknown
+        self.written_sheets: set[str | None] = set()
+        self.written = asyncio.Event()
+        self.read_bucket = TokenBucket(SHEETS_READ_QUOTA, SHEETS_BURST)
+        self.write_bucket = TokenBucket(SHEETS_WRITE_QUOTA, SHEETS_BURST)
+
+    async def _call(self, method, *args, **kwargs):
+        # replaces the fixed gspread_delay pause and endless retries of gspread_asyncio with per-minute quota
+        # buckets, where interactive calls go ahead of bulk ones, and a bounded jittered exponential backoff
+        api_call_count = kwargs.pop('api_call_count', 1)
+        bucket = self.write_bucket if method.__name__ in WRITE_METHODS else self.read_bucket
+        fn = functools.partial(method, *args, **kwargs)
+        attempt = 0
+        while True:
+            await bucket.acquire(api_call_count, sheets_lane.get())
+            try:
+                async with self.call_lock:
+                    await self.before_gspread_call(method, args, kwargs)
+                    return await asyncio.get_running_loop().run_in_executor(None, fn)
+            except gspread.exceptions.APIError as e:
+                code = e.response.status_code
+                if (code != 429 and code < 500) or attempt >= SHEETS_MAX_RETRIES:
+                    raise
+                if code == 429:
+                    bucket.drain()
+            except requests.RequestException:
+                if attempt >= SHEETS_MAX_RETRIES:
+                    raise
+            delay = get_backoff_delay(attempt, SHEETS_BACKOFF_BASE, SHEETS_BACKOFF_MAX)
+            logger.warning(f'Google Sheets {method.__name__} failed, retry {attempt + 1} in {delay:.1f}s')
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def before_gspread_call(self, method, args, kwargs):
+        await super().before_gspread_call(method, args, kwargs)
+        if method.__name__ in WRITE_METHODS:
+            owner = getattr(method, '__self__', None)
+            self.written_sheets.add(owner.title if isinstance(owner, gspread.Worksheet) else None)
+            self.written.set()
+
+    async def get_revision(self, sh: gspread_asyncio.AsyncioGspreadSpreadsheet) -> str:
+        await self._call(sh.ss.refresh_lastUpdateTime)
+        return sh.ss.lastUpdateTime
+
+    # unlike AsyncioGspreadClient.open_by_url and AsyncioGspreadSpreadsheet.worksheet these always hit the API,
+    # the handles are cached by SheetHandles instead
+
+    async def open_spreadsheet(self, agc: gspread_asyncio.AsyncioGspreadClient,
+                               url: str) -> gspread_asyncio.AsyncioGspreadSpreadsheet:
+        ss = await self._call(agc.gc.open_by_url, url)
+        return gspread_asyncio.AsyncioGspreadSpreadsheet(self, ss)
+
+    async def open_worksheet(self, sh: gspread_asyncio.AsyncioGspreadSpreadsheet,
+                             title: str) -> gspread_asyncio.AsyncioGspreadWorksheet:
+        ws = await self._call(sh.ss.worksheet, title)
+        return gspread_asyncio.AsyncioGspreadWorksheet(self, ws)
+
+
 # Create an AsyncioGspreadClientManager object which
 # will give us access to the Spreadsheet API.
 
-agcm = gspread_asyncio.AsyncioGspreadClientManager(get_creds)
-__gc = pygsheets.authorize(service_file='./gis-gkh-dce0833e31ca.json')
-__sh = __gc.open_by_url('https://docs.google.com/spreadsheets/d/1kGCdugwpVwuDO5LRC7tOxIkvMt_5iFQlGphLMAL107A/edit#gid=0')
-__sh.share('', role='writer', type='anyone')
-orgs_sheet: Worksheet = __sh.worksheet_by_title('Организации')
-mkd_sheet: Worksheet = __sh.worksheet_by_title('МКД')
-rooms_sheet: Worksheet = __sh.worksheet_by_title('Помещения')
+agcm = GspreadClientManager(get_creds)
 
 
 class Singleton(type):
@@ -53,3 +161,66 @@ class Singleton(type):
         if cls not in cls._instances:
             cls._instances[cls] = super(Singleton, cls).__call__(*args, **kwargs)
         return cls._instances[cls]
+
+
+class SheetHandles(metaclass=Singleton):
+    def __init__(self):
+        self.__client: gspread_asyncio.AsyncioGspreadClient | None = None
+        self.__spreadsheet: gspread_asyncio.AsyncioGspreadSpreadsheet | None = None
+        self.__worksheets: dict[str, gspread_asyncio.AsyncioGspreadWorksheet] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'worksheets': len(self.__worksheets)}
+
+    @single_flight(lambda self: None)
+    async def get_spreadsheet(self) -> gspread_asyncio.AsyncioGspreadSpreadsheet:
+        agc = await agcm.authorize()
+        if self.__spreadsheet is None:
+            self.misses += 1
+            self.__spreadsheet = await agcm.open_spreadsheet(agc, SPREADSHEET_URL)
+        else:
+            self.hits += 1
+            if agc is not self.__client:
+                self.__rebind(agc)
+        self.__client = agc
+        return self.__spreadsheet
+
+    @single_flight(lambda self, title: title)
+    async def get_worksheet(self, title: str) -> gspread_asyncio.AsyncioGspreadWorksheet:
+        sh = await self.get_spreadsheet()
+        if title in self.__worksheets:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.__worksheets[title] = await agcm.open_worksheet(sh, title)
+        return self.__worksheets[title]
+
+    def invalidate(self, title: str = None) -> NoReturn:
+        if title:
+            self.__worksheets.pop(title, None)
+        else:
+            self.__spreadsheet = None
+            self.__worksheets.clear()
+        logger.info(f'Sheet handles invalidated: {title or "all"}, {self.stats}')
+
+    def __rebind(self, agc: gspread_asyncio.AsyncioGspreadClient) -> NoReturn:
+        # agcm re-authorizes with a new gspread client, the cached handles only need its fresh credentials
+        self.__spreadsheet.ss.client = agc.gc
+        for sheet in self.__worksheets.values():
+            sheet.ws.client = agc.gc
+
+
+async def get_spreadsheet() -> gspread_asyncio.AsyncioGspreadSpreadsheet:
+    return await SheetHandles().get_spreadsheet()
+
+
+async def get_worksheet(title: str) -> gspread_asyncio.AsyncioGspreadWorksheet:
+    return await SheetHandles().get_worksheet(title)
+
+
+async def share_spreadsheet() -> NoReturn:
+    sh = await get_spreadsheet()
+    await agcm._call(sh.ss.share, None, perm_type='anyone', role='writer')
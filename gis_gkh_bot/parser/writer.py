@@ -0,0 +1,145 @@
+import asyncio
+import os
+import threading
+from asyncio import Task
+from contextlib import suppress
+from dataclasses import dataclass, field
+from enum import StrEnum
+from typing import NoReturn
+
+import gspread_asyncio
+from gspread.exceptions import APIError
+from loguru import logger
+
+from .limiter import Lane, sheets_lane
+from .repository import Repository
+from .utils import Singleton, SheetHandles, get_spreadsheet, get_worksheet
+
+SHEETS_WRITE_BATCH_SIZE = int(os.environ.get('SHEETS_WRITE_BATCH_SIZE', 100))
+SHEETS_WRITE_FLUSH_INTERVAL = float(os.environ.get('SHEETS_WRITE_FLUSH_INTERVAL', 30))
+
+
+class WriteOperation(StrEnum):
+    APPEND = 'append'
+    DELETE = 'delete'
+
+
+@dataclass
+class SheetBatch:
+    appends: list[list] = field(default_factory=list)
+    deletes: set[tuple[int, str]] = field(default_factory=set)
+    last_id: int = field(default=0)
+
+
+class SheetsWriter(metaclass=Singleton):
+    def __init__(self):
+        self.__lock = asyncio.Lock()
+        self.__journal_lock = threading.RLock()
+        self.__full = asyncio.Event()
+        self.__task: Task | None = None
+
+    @property
+    def journal_lock(self) -> threading.RLock:
+        # held while a row is saved to the repository and its sheet write is journaled, and by SheetsMirror while
+        # it replaces repository rows with a download, so a row is never overwritten before its write is pending
+        return self.__journal_lock
+
+    def start(self) -> NoReturn:
+        if not self.__task:
+            self.__task = asyncio.create_task(self.__flush_periodically())
+
+    def append(self, title: str, row: list) -> NoReturn:
+        self.__enqueue(title, WriteOperation.APPEND, row)
+
+    def delete(self, title: str, column: int, value: str) -> NoReturn:
+        self.__enqueue(title, WriteOperation.DELETE, [column, str(value)])
+
+    def __enqueue(self, title: str, operation: WriteOperation, payload: list) -> NoReturn:
+        repository = Repository()
+        repository.add_pending_write(title, operation, payload)
+        if repository.count_pending_writes() >= SHEETS_WRITE_BATCH_SIZE:
+            self.__full.set()
+
+    async def flush(self) -> NoReturn:
+        lane = sheets_lane.set(Lane.BULK)
+        try:
+            await self.__flush()
+        finally:
+            sheets_lane.reset(lane)
+
+    async def __flush(self) -> NoReturn:
+        async with self.__lock:
+            repository = Repository()
+            batches = self.__coalesce(repository.get_pending_writes())
+            if not batches:
+                return
+            sh = await get_spreadsheet()
+            for title, batch in batches.items():
+                # a failed sheet keeps its pending writes for the next flush and does not hold up the others
+                try:
+                    await self.__write_batch(sh, title, batch)
+                except APIError as ex:
+                    # a renamed or re-created sheet leaves a handle with a stale title or sheetId
+                    SheetHandles().invalidate(title)
+                    logger.error(f'Flush to {title} sheet failed, its writes are kept for the next flush: {ex}')
+                    continue
+                except Exception as ex:
+                    logger.opt(exception=ex).error(f'Flush to {title} sheet failed')
+                    continue
+                repository.delete_pending_writes(title, batch.last_id)
+                logger.info(f'Flushed {len(batch.appends)} appends and {len(batch.deletes)} deletes to {title} sheet')
+
+    @staticmethod
+    def __coalesce(writes: list[tuple[int, str, str, list]]) -> dict[str, SheetBatch]:
+        batches: dict[str, SheetBatch] = {}
+        for id_, title, operation, payload in writes:
+            batch = batches.setdefault(title, SheetBatch())
+            batch.last_id = id_
+            if operation == WriteOperation.APPEND:
+                batch.appends.append(payload)
+            else:
+                # rows appended earlier in the same batch are dropped before they are sent, so the remaining
+                # deletes only touch rows already in the sheet and can be applied ahead of every append
+                column, value = payload
+                batch.appends = [row for row in batch.appends if str(row[column]) != value]
+                batch.deletes.add((column, value))
+        return batches
+
+    @staticmethod
+    async def __write_batch(sh: gspread_asyncio.AsyncioGspreadSpreadsheet, title: str,
+                            batch: SheetBatch) -> NoReturn:
+        sheet = await get_worksheet(title)
+        if batch.deletes:
+            rows = set()
+            for column in {column for column, _ in batch.deletes}:
+                values = await sheet.col_values(column + 1)
+                targets = {value for column_, value in batch.deletes if column_ == column}
+                rows.update(index for index, value in enumerate(values) if index and value in targets)
+            if rows:
+                await sh.batch_update({'requests': [
+                    {'deleteDimension': {'range': {
+                        'sheetId': sheet.id, 'dimension': 'ROWS', 'startIndex': start, 'endIndex': end
+                    }}} for start, end in _get_descending_ranges(rows)
+                ]})
+        if batch.appends:
+            await sheet.append_rows(values=batch.appends)
+
+    async def __flush_periodically(self) -> NoReturn:
+        while True:
+            try:
+                await self.flush()
+            except Exception as ex:
+                logger.exception(ex)
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self.__full.wait(), SHEETS_WRITE_FLUSH_INTERVAL)
+            self.__full.clear()
+
+
+def _get_descending_ranges(rows: set[int]) -> list[tuple[int, int]]:
+    ranges = []
+    for row in sorted(rows, reverse=True):
+        if ranges and ranges[-1][0] == row + 1:
+            ranges[-1] = (row, ranges[-1][1])
+        else:
+            ranges.append((row, row + 1))
+    return ranges
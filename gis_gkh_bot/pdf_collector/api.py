@@ -1,33 +1,23 @@
 from pathlib import Path
-from pathlib import Path
 from typing import Literal
 
-from playwright.async_api import async_playwright, Page
+from playwright.async_api import Page
 
 from parser.mkd import MKD
 from parser.utils import Singleton, BASE_DIR
 from pdf_collector.control_info import ControlInfoCollector
 from pdf_collector.passport import PassportInfoCollector
+from pdf_collector.pool import BrowserPool
 
 
 class PDFCollector(metaclass=Singleton):
-    def __init__(self):
-        self.is_running = False
-
     async def run(self, action: Literal['control_info', 'passport'], passport_link: str, control_info_link: str,
                   address: str) -> Path:
-        self.is_running = True
-        async with async_playwright() as pw:
-            context = await pw.chromium.launch(headless=True)
-            async with context:
-                page = await context.new_page()
-                page.set_default_timeout(120_000)
-                if action == 'passport':
-                    path = await self.collect_passport_pdf(page, passport_link, address)
-                else:
-                    path = await self.collect_control_info_pdf(page, control_info_link, address)
-                self.is_running = False
-                return path
+        # every render leases a warm page of the shared browser, as many run at once as the pool has contexts
+        async with BrowserPool().lease() as page:
+            if action == 'passport':
+                return await self.collect_passport_pdf(page, passport_link, address)
+            return await self.collect_control_info_pdf(page, control_info_link, address)
 
     @staticmethod
     async def collect_passport_pdf(page: Page, link: str, address: str) -> Path:
@@ -1,5 +1,4 @@
 import asyncio
-import time
 from enum import StrEnum
 from pathlib import Path
 from typing import NoReturn
@@ -60,7 +59,7 @@ class ControlInfoCollector:
             await self.__click_dropdown_button()
         btn = await self.__page.wait_for_selector(tab.value)
 
-        time.sleep(5)  # TODO: research why later
+        await asyncio.sleep(5)  # TODO: research why later
 
         await btn.click()
         if tab == Tab.REPAIRINGS:
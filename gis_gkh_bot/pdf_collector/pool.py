@@ -0,0 +1,155 @@
+import asyncio
+import os
+from asyncio import Task
+from contextlib import asynccontextmanager, suppress
+from dataclasses import dataclass, field
+from typing import NoReturn, AsyncIterator
+
+from loguru import logger
+from playwright.async_api import async_playwright, Playwright, Browser, BrowserContext, Page
+
+from parser.utils import Singleton
+
+# contexts kept warm, also the number of PDFs rendered at once
+PDF_POOL_SIZE = int(os.environ.get('PDF_POOL_SIZE', 2))
+# a context is replaced after this many PDFs, the portal pages leak memory into the renderer
+PDF_CONTEXT_MAX_JOBS = int(os.environ.get('PDF_CONTEXT_MAX_JOBS', 20))
+PDF_PAGE_TIMEOUT = int(os.environ.get('PDF_PAGE_TIMEOUT', 120_000))
+PDF_HEALTH_CHECK_TIMEOUT = float(os.environ.get('PDF_HEALTH_CHECK_TIMEOUT', 5))
+# how long the shutdown waits for the running renders before closing the browser under them
+PDF_SHUTDOWN_TIMEOUT = float(os.environ.get('PDF_SHUTDOWN_TIMEOUT', 30))
+
+
+@dataclass
+class Slot:
+    browser: Browser
+    context: BrowserContext
+    page: Page
+    jobs: int = field(default=0)
+
+
+class BrowserPool(metaclass=Singleton):
+    # one long-lived Chromium with pre-warmed contexts, every PDF leases a page instead of launching a browser
+    def __init__(self):
+        self.__playwright: Playwright | None = None
+        self.__browser: Browser | None = None
+        self.__idle: list[Slot] = []
+        self.__slots = asyncio.Semaphore(PDF_POOL_SIZE)
+        self.__lock = asyncio.Lock()
+        self.__replenishing: set[Task] = set()
+        self.__closed = False
+
+    async def start(self) -> NoReturn:
+        # warms up every slot in advance, the first PDF after a restart does not wait for Chromium
+        await self.__get_browser()
+        while len(self.__idle) < PDF_POOL_SIZE:
+            self.__idle.append(await self.__create_slot())
+        logger.info(f'PDF browser pool started with {len(self.__idle)} contexts')
+
+    @asynccontextmanager
+    async def lease(self) -> AsyncIterator[Page]:
+        if self.__closed:
+            raise RuntimeError('PDF browser pool is closed')
+        async with self.__slots:
+            slot = await self.__acquire()
+            failed = True
+            try:
+                yield slot.page
+                failed = False
+            finally:
+                slot.jobs += 1
+                await self.__release(slot, failed)
+
+    async def close(self) -> NoReturn:
+        self.__closed = True
+        # the running renders get a grace period, the leases return their slots to the semaphore
+        with suppress(TimeoutError):
+            async with asyncio.timeout(PDF_SHUTDOWN_TIMEOUT):
+                for _ in range(PDF_POOL_SIZE):
+                    await self.__slots.acquire()
+        for task in self.__replenishing:
+            task.cancel()
+        for slot in self.__idle:
+            await self.__close_slot(slot)
+        self.__idle.clear()
+        if self.__browser:
+            with suppress(Exception):
+                await self.__browser.close()
+        if self.__playwright:
+            await self.__playwright.stop()
+        self.__browser = self.__playwright = None
+        logger.info('PDF browser pool closed')
+
+    async def __acquire(self) -> Slot:
+        while self.__idle:
+            slot = self.__idle.pop()
+            if await self.__is_healthy(slot):
+                return slot
+            logger.warning('PDF context failed the health check, replacing it')
+            await self.__close_slot(slot)
+        return await self.__create_slot()
+
+    async def __release(self, slot: Slot, failed: bool) -> NoReturn:
+        if self.__closed:
+            await self.__close_slot(slot)
+            return
+        if not failed and slot.jobs < PDF_CONTEXT_MAX_JOBS:
+            try:
+                # the next job starts from a blank page, and the renderer drops the previous portal page
+                await slot.page.goto('about:blank')
+                self.__idle.append(slot)
+                return
+            except Exception as ex:
+                logger.warning(f'PDF page reset failed: {ex}')
+        logger.info(f'Recycling PDF context after {slot.jobs} jobs{" and a failure" if failed else ""}')
+        await self.__close_slot(slot)
+        # the replacement is warmed up in the background, the caller already has its PDF
+        task = asyncio.create_task(self.__replenish())
+        self.__replenishing.add(task)
+        task.add_done_callback(self.__replenishing.discard)
+
+    async def __replenish(self) -> NoReturn:
+        try:
+            slot = await self.__create_slot()
+        except Exception as ex:
+            # the next lease creates the slot itself
+            logger.warning(f'PDF context warm up failed: {ex}')
+            return
+        if self.__closed or len(self.__idle) >= PDF_POOL_SIZE:
+            await self.__close_slot(slot)
+        else:
+            self.__idle.append(slot)
+
+    async def __is_healthy(self, slot: Slot) -> bool:
+        # slots of a crashed or relaunched browser and closed pages are never handed out
+        if slot.browser is not self.__browser or not slot.browser.is_connected() or slot.page.is_closed():
+            return False
+        try:
+            await asyncio.wait_for(slot.page.evaluate('1'), PDF_HEALTH_CHECK_TIMEOUT)
+            return True
+        except Exception:
+            return False
+
+    async def __create_slot(self) -> Slot:
+        browser = await self.__get_browser()
+        context = await browser.new_context()
+        page = await context.new_page()
+        page.set_default_timeout(PDF_PAGE_TIMEOUT)
+        return Slot(browser, context, page)
+
+    async def __get_browser(self) -> Browser:
+        # launched once and again only after a crash, concurrent leases wait for the same launch
+        async with self.__lock:
+            if self.__browser is None or not self.__browser.is_connected():
+                if self.__browser is not None:
+                    logger.warning('PDF browser disconnected, launching a new one')
+                if self.__playwright is None:
+                    self.__playwright = await async_playwright().start()
+                self.__browser = await self.__playwright.chromium.launch(headless=True)
+            return self.__browser
+
+    @staticmethod
+    async def __close_slot(slot: Slot) -> NoReturn:
+        # the context may be gone with its browser already
+        with suppress(Exception):
+            await slot.context.close()